@@ -1,35 +1,162 @@
-import requests
+import asyncio
+import httpx
 import logging
+import re
+from http_client import get_client
+from cache import TTLCache
+from config import (
+    SCHEDULE_CACHE_TTL, SCHEDULE_CACHE_STALE_TTL, SCHEDULE_CACHE_MAX_SIZE, SCHEDULE_FETCH_CONCURRENCY
+)
 
 logger = logging.getLogger(__name__)
 
+schedule_cache = TTLCache(
+    "schedule",
+    ttl=SCHEDULE_CACHE_TTL,
+    max_size=SCHEDULE_CACHE_MAX_SIZE,
+    stale_ttl=SCHEDULE_CACHE_STALE_TTL
+)
 
-def fetch_bookings(date_str, api_base_url):
-    """Получение данных о бронированиях"""
+
+_CLOCK_RE = re.compile(r'(\d{1,2}):(\d{2})')
+
+
+class Booking:
+    """
+    Бронирование из ответа API, разобранное один раз при получении:
+    время хранится в минутах от начала суток, текст для показа готов заранее.
+    """
+    __slots__ = (
+        'room_id', 'name', 'phone', 'comment', 'status', 'is_cancelled',
+        'start_minutes', 'end_minutes', 'times_text'
+    )
+
+    # Ключ сортировки для бронирований без времени — в конец списка
+    NO_TIME = 24 * 60
+
+    def __init__(self, room_id, name, phone, comment, status, start_minutes, end_minutes, times_text):
+        self.room_id = room_id
+        self.name = name
+        self.phone = phone
+        self.comment = comment
+        self.status = status
+        self.is_cancelled = 'cancel' in status
+        self.start_minutes = start_minutes
+        self.end_minutes = end_minutes
+        self.times_text = times_text
+
+    @classmethod
+    def from_dict(cls, data):
+        room_id = data.get('room_id')
+        if isinstance(room_id, str) and room_id.isdigit():
+            room_id = int(room_id)
+        times_text, start_minutes, end_minutes = parse_times(data.get('times', ''))
+        return cls(
+            room_id=room_id,
+            name=data.get('name', 'Без имени'),
+            phone=data.get('phone', 'Не указан'),
+            comment=data.get('comment'),
+            status=str(data.get('status', '')).lower(),
+            start_minutes=start_minutes,
+            end_minutes=end_minutes,
+            times_text=times_text
+        )
+
+    @property
+    def sort_key(self):
+        return self.NO_TIME if self.start_minutes is None else self.start_minutes
+
+    def __repr__(self):
+        return f"Booking(room_id={self.room_id!r}, name={self.name!r}, times={self.times_text!r})"
+
+
+def parse_times(times_str):
+    """
+    Разбирает поле times за один проход.
+    Возвращает (текст для показа как у extract_times, начало и конец в минутах или None).
+    """
+    if not times_str:
+        return "Время не указано", None, None
+
+    display_lines = []
+    start_minutes = end_minutes = None
+    for line in times_str.split('\r\n'):
+        if '-' not in line:
+            continue
+        clocks = _CLOCK_RE.findall(line)
+        if not clocks and not any(char.isdigit() for char in line):
+            continue
+        line = line.strip()
+        display_lines.append(line[:-6] if len(line) >= 6 else line)
+        if clocks:
+            start = int(clocks[0][0]) * 60 + int(clocks[0][1])
+            end = int(clocks[1][0]) * 60 + int(clocks[1][1]) if len(clocks) > 1 else start
+            if start_minutes is None or start < start_minutes:
+                start_minutes = start
+            if end_minutes is None or end > end_minutes:
+                end_minutes = end
+
+    return ('\n'.join(display_lines) if display_lines else "Время не указано"), start_minutes, end_minutes
+
+
+async def fetch_bookings(date_str, api_base_url):
+    """Получение данных о бронированиях (список Booking или None при ошибке)"""
     try:
         api_url = f"{api_base_url}/{date_str}/"
         logger.info(f"Запрос к API: {api_url}")
-        response = requests.get(api_url)
+        response = await get_client().get(api_url)
 
         if response.status_code != 200:
             logger.error(f"API вернул код ошибки: {response.status_code}")
             return None
 
         try:
-            return response.json()
+            data = response.json()
         except Exception as json_error:
             logger.error(f"Ошибка декодирования JSON: {json_error}")
             logger.error(f"Ответ API: {response.text[:500]}...")
             return None
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка запроса к API: {e}")
+        if not isinstance(data, list):
+            logger.error(f"Неожиданный формат ответа API: {type(data).__name__}")
+            return None
+        return [Booking.from_dict(item) for item in data if isinstance(item, dict)]
+
+    except httpx.HTTPError as e:
+        logger.error(f"Ошибка запроса к API: {e!r}")
         return None
     except Exception as e:
         logger.error(f"Неизвестная ошибка при работе с API: {e}")
         return None
 
 
+async def fetch_bookings_cached(date_str, api_base_url, fresh=False):
+    """
+    Получение бронирований через кэш расписания (stale-while-revalidate).
+    fresh=True игнорирует кэш и обновляет запись.
+    """
+    key = (api_base_url, date_str)
+    fetcher = lambda: fetch_bookings(date_str, api_base_url)
+    if fresh:
+        return await schedule_cache.refresh(key, fetcher)
+    return await schedule_cache.get(key, fetcher)
+
+
+async def fetch_bookings_for_dates(date_strs, api_base_url, concurrency=SCHEDULE_FETCH_CONCURRENCY):
+    """
+    Параллельно получает бронирования на несколько дат (не более concurrency
+    запросов одновременно). Возвращает {date_str: список Booking или None}.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(date_str):
+        async with semaphore:
+            return await fetch_bookings_cached(date_str, api_base_url)
+
+    results = await asyncio.gather(*(fetch_one(date_str) for date_str in date_strs))
+    return dict(zip(date_strs, results))
+
+
 def extract_times(times_str):
     """Извлекает временные интервалы"""
     if not times_str:
@@ -0,0 +1,334 @@
+"""
+Микробенчмарки горячих путей бота. Работают без сети: ответы API и
+страницы сайта бронирования берутся из benchmarks/fixtures, HTTP-запросы
+обслуживает httpx.MockTransport.
+
+Запуск из корня репозитория:
+    python benchmarks/hot_paths.py --output bench.json
+    python benchmarks/hot_paths.py --compare bench.json      # сравнить с прошлым запуском
+    python benchmarks/hot_paths.py --only calendar,persistence
+
+Результаты (микросекунды на операцию, лучший и медианный из повторов)
+записываются в JSON. С --compare код возврата 1, если какой-либо замер
+медленнее базового больше чем в --max-regression раз.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+
+import http_client  # noqa: E402
+import booking_utils  # noqa: E402
+import keyboards  # noqa: E402
+from api_utils import Booking, extract_times, get_start_time, fetch_bookings  # noqa: E402
+from booking_parser import parse_slots, parse_booking_form  # noqa: E402
+from booking_utils import fetch_available_slots, submit_booking  # noqa: E402
+from config import API_BASE_URL, ROOM_NAMES  # noqa: E402
+from handlers import build_booking_messages, build_week_grid, pack_messages  # noqa: E402
+from sqlite_persistence import SQLitePersistence  # noqa: E402
+
+TARGET_SECONDS = 0.2
+REPEAT = 5
+USER_ID = 100500  # не администратор
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+SCHEDULE_JSON = load('schedule_api.json')
+SCHEDULE = json.loads(SCHEDULE_JSON)
+BOOKINGS = [Booking.from_dict(item) for item in SCHEDULE]
+SLOTS_HTML = load('booking_slots.html')
+FORM_HTML = load('booking_form.html')
+SUCCESS_HTML = load('booking_success.html')
+
+
+def upstream(request):
+    """Ответы API расписания и сайта бронирования из записанных страниц"""
+    url = str(request.url)
+    if url.startswith(API_BASE_URL):
+        return httpx.Response(200, text=SCHEDULE_JSON, headers={'Content-Type': 'application/json'})
+    if request.method == 'POST':
+        return httpx.Response(200, text=SUCCESS_HTML)
+    if 'time=' in url:
+        return httpx.Response(200, text=FORM_HTML)
+    return httpx.Response(200, text=SLOTS_HTML)
+
+
+def install_mock_transport():
+    transport = httpx.MockTransport(upstream)
+    http_client._client = httpx.AsyncClient(transport=transport, follow_redirects=True)
+    booking_utils.new_session = lambda: httpx.AsyncClient(transport=transport, follow_redirects=True)
+
+
+# --- Замеры ---------------------------------------------------------------
+
+def bench_extract_times():
+    for item in SCHEDULE:
+        extract_times(item['times'])
+
+
+def bench_get_start_time():
+    for item in SCHEDULE:
+        get_start_time(item)
+
+
+def bench_booking_from_dict():
+    for item in SCHEDULE:
+        Booking.from_dict(item)
+
+
+def bench_parse_slots():
+    parse_slots(SLOTS_HTML)
+
+
+def bench_parse_booking_form():
+    parse_booking_form(FORM_HTML)
+
+
+def bench_calendar_build():
+    keyboards._build_calendar.cache_clear()
+    keyboards.generate_calendar(2030, 5, '3', USER_ID, ROOM_NAMES, 'booking')
+
+
+def bench_calendar_cached():
+    keyboards.generate_calendar(2030, 5, '3', USER_ID, ROOM_NAMES, 'booking')
+
+
+def bench_booking_messages():
+    pack_messages(build_booking_messages(BOOKINGS, USER_ID, 'all'))
+
+
+WEEK_START = datetime.date(2030, 5, 6)
+WEEK = {WEEK_START + datetime.timedelta(days=offset): BOOKINGS for offset in range(7)}
+
+
+def bench_week_grid():
+    pack_messages(build_week_grid(WEEK_START, WEEK, 'all'))
+
+
+async def bench_fetch_bookings():
+    await fetch_bookings('20300506', API_BASE_URL)
+
+
+async def bench_fetch_available_slots():
+    await fetch_available_slots(3, '2030-05-06')
+
+
+async def bench_submit_booking():
+    await submit_booking(3, 'Кузня', '2030-05-06', ['10:00'], [('10:00', '10:00 - 11:00 (₽500)')],
+                         'Иван', '+79110000000', '')
+
+
+class PersistenceBench:
+    """Циклы чтения/записи SQLitePersistence во временной базе"""
+
+    USERS = 200
+
+    def __init__(self, directory):
+        self.persistence = SQLitePersistence(os.path.join(directory, 'bench.db'))
+        self.counter = 0
+
+    async def seed(self):
+        for user_id in range(self.USERS):
+            await self.persistence.update_user_data(user_id, self.user_data(user_id))
+            await self.persistence.update_conversation('booking_conversation', (user_id, user_id), 5)
+        await self.persistence.flush()
+
+    @staticmethod
+    def user_data(user_id, step=0):
+        return {
+            'booking_room_id': 3,
+            'booking_room_name': ROOM_NAMES[3],
+            'booking_date': '2030-05-06',
+            'booking_slots': [(f"{hour:02d}:00", f"{hour:02d}:00 - {hour + 1:02d}:00 (₽500)") for hour in range(9, 23)],
+            'selected_slots': ['10:00', '11:00'],
+            'booking_name': f"Пользователь {user_id}",
+            'step': step,
+        }
+
+    async def write_changed(self):
+        self.counter += 1
+        await self.persistence.update_user_data(self.counter % self.USERS, self.user_data(0, self.counter))
+        await self.persistence.flush()
+
+    async def write_unchanged(self):
+        await self.persistence.update_user_data(0, self.user_data(0, self.counter))
+
+    async def conversation_update(self):
+        self.counter += 1
+        await self.persistence.update_conversation('booking_conversation', (1, 1), 5 + self.counter % 5)
+        await self.persistence.flush()
+
+    async def read_user_data(self):
+        await self.persistence.get_user_data()
+
+    async def read_conversations(self):
+        await self.persistence.get_conversations('booking_conversation')
+
+
+# --- Запуск ---------------------------------------------------------------
+
+def time_sync(func, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - started
+
+
+def time_async(loop, func, number):
+    async def run():
+        started = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - started
+    return loop.run_until_complete(run())
+
+
+def measure(loop, func):
+    """Подбирает число повторов на ~TARGET_SECONDS и возвращает мкс/операцию"""
+    is_async = asyncio.iscoroutinefunction(func)
+    timer = (lambda number: time_async(loop, func, number)) if is_async else (lambda number: time_sync(func, number))
+
+    timer(1)  # прогрев
+    number = 1
+    while True:
+        elapsed = timer(number)
+        if elapsed >= TARGET_SECONDS / 5 or number >= 1_000_000:
+            break
+        number *= 10
+    number = max(1, int(number * TARGET_SECONDS / max(elapsed, 1e-9)))
+
+    samples = [timer(number) / number * 1e6 for _ in range(REPEAT)]
+    return {
+        'us_per_op': round(min(samples), 3),
+        'us_per_op_median': round(statistics.median(samples), 3),
+        'number': number,
+        'repeat': REPEAT,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def collect(loop, directory):
+    persistence = PersistenceBench(directory)
+    loop.run_until_complete(persistence.seed())
+    benchmarks = [
+        # (группа, имя, функция, элементов за операцию)
+        ('times', 'extract_times', bench_extract_times, len(SCHEDULE)),
+        ('times', 'get_start_time', bench_get_start_time, len(SCHEDULE)),
+        ('times', 'booking_from_dict', bench_booking_from_dict, len(SCHEDULE)),
+        ('parsing', 'parse_slots', bench_parse_slots, 1),
+        ('parsing', 'parse_booking_form', bench_parse_booking_form, 1),
+        ('calendar', 'generate_calendar_build', bench_calendar_build, 1),
+        ('calendar', 'generate_calendar_cached', bench_calendar_cached, 1),
+        ('messages', 'send_bookings_assembly', bench_booking_messages, len(BOOKINGS)),
+        ('messages', 'week_grid', bench_week_grid, len(BOOKINGS) * len(WEEK)),
+        ('upstream', 'fetch_bookings', bench_fetch_bookings, len(SCHEDULE)),
+        ('upstream', 'fetch_available_slots', bench_fetch_available_slots, 1),
+        ('upstream', 'submit_booking', bench_submit_booking, 1),
+        ('persistence', 'persistence_write_changed', persistence.write_changed, 1),
+        ('persistence', 'persistence_write_unchanged', persistence.write_unchanged, 1),
+        ('persistence', 'persistence_conversation_update', persistence.conversation_update, 1),
+        ('persistence', 'persistence_read_user_data', persistence.read_user_data, PersistenceBench.USERS),
+        ('persistence', 'persistence_read_conversations', persistence.read_conversations, PersistenceBench.USERS),
+    ]
+    return benchmarks, persistence
+
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    print(f"\nСравнение с {baseline_path}:")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"  {name:34} новый замер")
+            continue
+        ratio = result['us_per_op'] / baseline[name]['us_per_op']
+        mark = ""
+        if ratio > max_regression:
+            mark = "  <-- регрессия"
+            regressions.append(name)
+        print(f"  {name:34} {baseline[name]['us_per_op']:12.2f} -> {result['us_per_op']:12.2f} us  x{ratio:.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="куда записать результаты (JSON)")
+    parser.add_argument('--compare', help="файл результатов прошлого запуска для сравнения")
+    parser.add_argument('--max-regression', type=float, default=1.5,
+                        help="допустимое замедление относительно --compare (по умолчанию 1.5)")
+    parser.add_argument('--only', help="группы или имена замеров через запятую")
+    args = parser.parse_args()
+
+    install_mock_transport()
+    selected = set(args.only.split(',')) if args.only else None
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks, persistence = collect(loop, directory)
+        try:
+            for group, name, func, items in benchmarks:
+                if selected and group not in selected and name not in selected:
+                    continue
+                result = measure(loop, func)
+                result.update(group=group, items=items)
+                results[name] = result
+                print(f"{group:12} {name:34} {result['us_per_op']:12.2f} us/op "
+                      f"(медиана {result['us_per_op_median']:.2f}, n={result['number']})")
+        finally:
+            loop.run_until_complete(persistence.persistence.close())
+            loop.run_until_complete(http_client.close_client())
+    loop.close()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target_seconds': TARGET_SECONDS,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты записаны в {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+        if regressions:
+            print(f"\nРегрессии: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
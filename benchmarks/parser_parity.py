@@ -0,0 +1,89 @@
+"""
+Проверка совпадения booking_parser с прежним разбором через BeautifulSoup
+на сохраненных страницах и сравнение затрат CPU и памяти.
+
+Запуск из корня репозитория:
+    python benchmarks/parser_parity.py
+Код возврата 1, если результаты расходятся.
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+
+from booking_parser import parse_slots, parse_booking_form  # noqa: E402
+
+SLOT_FIXTURES = ['booking_slots.html', 'booking_slots_empty.html', 'booking_slots_tricky.html']
+FORM_FIXTURES = ['booking_form.html', 'booking_slots.html']
+
+
+def reference_slots(html):
+    """Прежняя реализация из fetch_available_slots"""
+    soup = BeautifulSoup(html, 'html.parser')
+    slots = []
+    for alert in soup.find_all('div', class_='alert alert-success'):
+        time_input = alert.find('input', {'name': 'time'})
+        if time_input:
+            value = time_input.get('value')
+            label_text = alert.get_text(strip=True)
+            label_text = ' '.join(label_text.split())
+            slots.append((value, label_text))
+    return slots
+
+
+def reference_form(html):
+    """Прежняя реализация из submit_booking"""
+    soup = BeautifulSoup(html, 'html.parser')
+    token_input = soup.find('input', {'name': '_token'})
+    token = token_input.get('value') if token_input else None
+    form = soup.find('form')
+    action = form.get('action') if form else None
+    return token, action
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def measure(func, html, number=200):
+    seconds = min(timeit.repeat(lambda: func(html), number=number, repeat=3)) / number
+    tracemalloc.start()
+    func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds * 1e6, peak / 1024
+
+
+def check(title, fixtures, reference, fast):
+    ok = True
+    for name in fixtures:
+        html = load(name)
+        expected, actual = reference(html), fast(html)
+        if expected != actual:
+            ok = False
+            print(f"MISMATCH {title} {name}:\n  bs4:  {expected!r}\n  fast: {actual!r}")
+            continue
+        ref_us, ref_kb = measure(reference, html)
+        fast_us, fast_kb = measure(fast, html)
+        print(
+            f"ok  {title:5} {name:28} bs4 {ref_us:8.1f} us {ref_kb:7.1f} KiB | "
+            f"fast {fast_us:8.1f} us {fast_kb:7.1f} KiB | x{ref_us / fast_us:.1f} CPU"
+        )
+    return ok
+
+
+def main():
+    ok = check('slots', SLOT_FIXTURES, reference_slots, parse_slots)
+    ok = check('form', FORM_FIXTURES, reference_form, parse_booking_form) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,420 @@
+"""
+Локальный эмулятор внешних сервисов бота: API расписания (/all/{ГГГГММДД}/)
+и сайта бронирования (/book: страница слотов, форма с CSRF-токеном,
+POST /book/store со страницей «Благодарим за Ваш выбор»).
+
+Занятость генерируется детерминированно по (seed, зал, дата) и меняется
+при успешной отправке формы, так что новые брони видны и в расписании,
+и на странице слотов. Задержка, доля ошибок 500 и обрывов соединения
+настраиваются; счетчики запросов доступны по GET /_stats.
+
+Запуск из корня репозитория:
+    python benchmarks/upstream_emulator.py --port 8080 --latency 0.3 --error-rate 0.05
+    BOT_API_BASE_URL=http://127.0.0.1:8080/all \\
+    BOT_BOOKING_BASE_URL=http://127.0.0.1:8080/book python main.py
+"""
+import argparse
+import asyncio
+import datetime
+import html
+import json
+import logging
+import random
+import secrets
+import time
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger('upstream_emulator')
+
+SESSION_COOKIE = 'laravel_session'
+SUCCESS_PHRASE = 'Благодарим за Ваш выбор'
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    419: 'Page Expired', 422: 'Unprocessable Entity', 500: 'Internal Server Error'
+}
+
+_GUEST_NAMES = ["Иван", "Группа «Северный ветер»", "Мария К.", "Кавер-бэнд Z", "Алексей", "Дуэт «Онего»"]
+
+
+def parse_date(value):
+    """ГГГГММДД (API расписания) или ГГГГ-ММ-ДД (сайт бронирования)"""
+    for fmt in ('%Y%m%d', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class Inventory:
+    """
+    Занятость залов по часам. День создается при первом обращении:
+    каждый час занят с вероятностью occupancy (детерминированно по seed).
+    overrides: {зал: {"ГГГГ-ММ-ДД": ["10:00", ...]}} — явный список свободных слотов.
+    """
+
+    def __init__(self, rooms, first_hour, last_hour, occupancy, price, seed=0, overrides=None):
+        self.rooms = rooms
+        self.hours = range(first_hour, last_hour)
+        self.occupancy = occupancy
+        self.price = price
+        self.seed = seed
+        self.overrides = overrides or {}
+        self._days = {}  # (room, date) -> {hour: бронь}
+
+    def _day(self, room, date):
+        key = (room, date)
+        day = self._days.get(key)
+        if day is not None:
+            return day
+
+        day = {}
+        override = self.overrides.get(str(room), {}).get(date.isoformat())
+        rnd = random.Random(f"{self.seed}:{room}:{date.isoformat()}")
+        if override is not None:
+            free = {int(value.split(':')[0]) for value in override}
+            booked_hours = [hour for hour in self.hours if hour not in free]
+        else:
+            booked_hours = [hour for hour in self.hours if rnd.random() < self.occupancy]
+
+        booking = None
+        for hour in booked_hours:
+            # Соседние занятые часы — одна бронь
+            if booking is None or hour - 1 not in day:
+                booking = {
+                    'name': rnd.choice(_GUEST_NAMES),
+                    'phone': f"+7-911-{rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(10, 99)}",
+                    'comment': None,
+                    'status': 'Подтверждено',
+                }
+            day[hour] = booking
+
+        self._days[key] = day
+        return day
+
+    def free_hours(self, room, date):
+        day = self._day(room, date)
+        return [hour for hour in self.hours if hour not in day]
+
+    def book(self, room, date, hours, name, phone, comment):
+        """Занимает часы; False, если хотя бы один уже занят"""
+        day = self._day(room, date)
+        if any(hour in day or hour not in self.hours for hour in hours):
+            return False
+        booking = {'name': name, 'phone': phone, 'comment': comment, 'status': 'Ожидает'}
+        for hour in hours:
+            day[hour] = booking
+        return True
+
+    def slot_label(self, hour):
+        return f"{hour:02d}:00 - {hour + 1:02d}:00"
+
+    def schedule(self, date):
+        """Ответ API расписания: список броней всех залов на дату"""
+        result = []
+        for room in self.rooms:
+            day = self._day(room, date)
+            current, lines = None, []
+            for hour in sorted(day):
+                if day[hour] is not current and current is not None:
+                    result.append(self._schedule_item(room, current, lines))
+                    lines = []
+                current = day[hour]
+                lines.append(f"{self.slot_label(hour)} (₽{self.price})")
+            if current is not None:
+                result.append(self._schedule_item(room, current, lines))
+        return result
+
+    @staticmethod
+    def _schedule_item(room, booking, lines):
+        return dict(booking, room_id=room, times="\r\n".join(lines) + "\r\n")
+
+
+class UpstreamEmulator:
+    def __init__(self, inventory, latency=0.0, jitter=0.0, error_rate=0.0, drop_rate=0.0,
+                 token_ttl=7200, seed=None):
+        self.inventory = inventory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.sessions = {}  # session id -> (csrf token, выдан)
+        self.stats = Counter()
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ', 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                body = await reader.readexactly(length) if length else b''
+
+                keep_alive = await self.handle_request(method, target, headers, body, writer)
+                if not keep_alive or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, target, headers, body, writer):
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path
+
+        if path == '/_stats':
+            await self.respond(writer, 200, json.dumps(self.stats, ensure_ascii=False), 'application/json')
+            return True
+
+        self.stats['requests'] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+        if self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            return False
+        if self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            await self.respond(writer, 500, "<h1>Server Error</h1>")
+            return True
+
+        cookies = self.parse_cookies(headers.get('cookie', ''))
+        extra_headers = []
+        if path.startswith('/all/'):
+            content_type = 'application/json'
+            status, payload = self.schedule(path)
+        elif path == '/book' and method == 'GET':
+            content_type = 'text/html; charset=utf-8'
+            if query.get('time'):
+                status, payload, extra_headers = self.booking_form(query, cookies)
+            else:
+                status, payload = self.slots_page(query)
+        elif path == '/book/store':
+            content_type = 'text/html; charset=utf-8'
+            if method != 'POST':
+                status, payload = 405, ''
+            else:
+                form = {key: values[-1] for key, values in parse_qs(body.decode('utf-8'), keep_blank_values=True).items()}
+                status, payload = self.store(form, cookies)
+        else:
+            status, payload, content_type = 404, '<h1>Not Found</h1>', 'text/html; charset=utf-8'
+
+        await self.respond(writer, status, payload, content_type, extra_headers)
+        return True
+
+    @staticmethod
+    def parse_cookies(header):
+        cookies = {}
+        for part in header.split(';'):
+            if '=' in part:
+                name, value = part.split('=', 1)
+                cookies[name.strip()] = value.strip()
+        return cookies
+
+    @staticmethod
+    async def respond(writer, status, payload, content_type='text/html; charset=utf-8', extra_headers=()):
+        body = payload.encode('utf-8')
+        head = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'Unknown')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: keep-alive",
+            *extra_headers,
+        ]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('utf-8') + body)
+        await writer.drain()
+
+    # --- Маршруты ---
+
+    def schedule(self, path):
+        self.stats['api_schedule'] += 1
+        date = parse_date(path[len('/all/'):].strip('/'))
+        if date is None:
+            return 404, json.dumps({'error': 'bad date'})
+        return 200, json.dumps(self.inventory.schedule(date), ensure_ascii=False)
+
+    def _room_and_date(self, params):
+        room, date = params.get('room', ''), parse_date(params.get('date'))
+        if not room.isdigit() or int(room) not in self.inventory.rooms or date is None:
+            return None, None
+        return int(room), date
+
+    def slots_page(self, query):
+        self.stats['book_slots'] += 1
+        room, date = self._room_and_date(query)
+        if room is None:
+            return 404, self.page("Зал или дата не найдены")
+
+        free = set(self.inventory.free_hours(room, date))
+        blocks = []
+        for hour in self.inventory.hours:
+            label = self.inventory.slot_label(hour)
+            if hour in free:
+                blocks.append(
+                    '<div class="col-md-4"><div class="alert alert-success"><label class="mb-0">'
+                    f'<input type="checkbox" name="time" value="{hour:02d}:00"> {label} '
+                    f'<span class="slot-price">(&#8381;{self.inventory.price})</span></label></div></div>'
+                )
+            else:
+                blocks.append(
+                    f'<div class="col-md-4"><div class="alert alert-danger"><span>{label}</span> '
+                    '<small>Занято</small></div></div>'
+                )
+        return 200, self.page(
+            f'<form method="GET" action="/book"><input type="hidden" name="room" value="{room}">'
+            f'<input type="hidden" name="date" value="{date.isoformat()}">'
+            f'<div class="row">{"".join(blocks)}</div>'
+            '<button type="submit" class="btn btn-primary">Далее</button></form>'
+        )
+
+    def _session(self, cookies):
+        """Действующая сессия (id, токен) или новая, если сессии нет или она истекла"""
+        session_id = cookies.get(SESSION_COOKIE)
+        session = self.sessions.get(session_id)
+        if session is not None and time.monotonic() - session[1] < self.token_ttl:
+            return session_id, session[0], False
+        session_id, token = secrets.token_urlsafe(24), secrets.token_urlsafe(30)
+        self.sessions[session_id] = (token, time.monotonic())
+        return session_id, token, True
+
+    def booking_form(self, query, cookies):
+        self.stats['book_form'] += 1
+        room, date = self._room_and_date(query)
+        if room is None:
+            return 404, self.page("Зал или дата не найдены"), []
+
+        hours = self.parse_hours(query.get('time', ''))
+        free = set(self.inventory.free_hours(room, date))
+        if not hours or not set(hours) <= free:
+            # Как на сайте: формы (и токена) нет, если слоты уже заняты
+            self.stats['form_conflicts'] += 1
+            return 200, self.page("Выбранное время уже занято. Выберите другие слоты."), []
+
+        session_id, token, created = self._session(cookies)
+        extra_headers = [f"Set-Cookie: {SESSION_COOKIE}={session_id}; Path=/; HttpOnly"] if created else []
+        return 200, self.page(
+            f'<h2>Оформление заявки</h2>'
+            f'<form method="POST" action="/book/store" class="booking-form">'
+            f'<input type="hidden" name="_token" value="{token}">'
+            f'<input type="hidden" name="room" value="{room}">'
+            f'<input type="hidden" name="date" value="{date.isoformat()}">'
+            f'<input type="hidden" name="time" value="{html.escape(query["time"])}">'
+            '<input type="text" name="name" required><input type="tel" name="phone" required>'
+            '<textarea name="comment"></textarea><input type="checkbox" name="rules">'
+            '<button type="submit" name="submit">Забронировать</button></form>'
+        ), extra_headers
+
+    def store(self, form, cookies):
+        self.stats['book_submit'] += 1
+        session = self.sessions.get(cookies.get(SESSION_COOKIE))
+        if (session is None or time.monotonic() - session[1] >= self.token_ttl
+                or not secrets.compare_digest(form.get('_token', ''), session[0])):
+            self.stats['csrf_failures'] += 1
+            return 419, self.page("Страница устарела (CSRF). Обновите страницу и попробуйте снова.")
+
+        room, date = self._room_and_date(form)
+        hours = self.parse_hours(form.get('time', ''))
+        if room is None or not hours or not form.get('name') or not form.get('phone') or form.get('rules') != 'on':
+            self.stats['invalid_submits'] += 1
+            return 422, self.page("Заполните все обязательные поля.")
+
+        if not self.inventory.book(room, date, hours, form['name'], form['phone'], form.get('comment')):
+            self.stats['submit_conflicts'] += 1
+            return 200, self.page("Выбранное время уже занято. Выберите другие слоты.")
+
+        self.stats['bookings_created'] += 1
+        return 200, self.page(f"<h4>{SUCCESS_PHRASE}!</h4><p>Ваша заявка принята.</p>")
+
+    @staticmethod
+    def parse_hours(value):
+        hours = []
+        for item in value.split(','):
+            hour = item.strip().split(':')[0]
+            if not hour.isdigit():
+                return []
+            hours.append(int(hour))
+        return hours
+
+    @staticmethod
+    def page(content):
+        return (
+            '<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8">'
+            '<title>Бронирование репетиционных залов</title></head>'
+            f'<body><main class="py-4"><div class="container">{content}</div></main></body></html>'
+        )
+
+
+async def serve(emulator, host, port):
+    server = await asyncio.start_server(emulator.handle_connection, host, port)
+    logger.info(f"Эмулятор слушает http://{host}:{port} (API: /all, бронирование: /book, счетчики: /_stats)")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="средняя задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="разброс задержки (±), с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="доля запросов, на которые соединение закрывается без ответа")
+    parser.add_argument('--rooms', default='1,3,4,5', help="номера залов через запятую")
+    parser.add_argument('--hours', default='9-23', help="часы работы, например 9-23")
+    parser.add_argument('--occupancy', type=float, default=0.3, help="доля занятых часов")
+    parser.add_argument('--price', type=int, default=500)
+    parser.add_argument('--inventory', help="JSON со свободными слотами: {зал: {ГГГГ-ММ-ДД: [\"10:00\", ...]}}")
+    parser.add_argument('--token-ttl', type=float, default=7200, help="время жизни CSRF-токена, с")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    overrides = None
+    if args.inventory:
+        with open(args.inventory, encoding='utf-8') as f:
+            overrides = json.load(f)
+    first_hour, last_hour = (int(value) for value in args.hours.split('-'))
+    inventory = Inventory(
+        rooms=[int(room) for room in args.rooms.split(',')],
+        first_hour=first_hour,
+        last_hour=last_hour,
+        occupancy=args.occupancy,
+        price=args.price,
+        seed=args.seed,
+        overrides=overrides
+    )
+    emulator = UpstreamEmulator(
+        inventory,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        token_ttl=args.token_ttl,
+        seed=args.seed
+    )
+    try:
+        asyncio.run(serve(emulator, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+from html.parser import HTMLParser
+
+# Текст внутри этих тегов не входит в get_text() у BeautifulSoup
+_SKIP_TEXT_TAGS = {'script', 'style', 'template'}
+_VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+
+class _StopParsing(Exception):
+    pass
+
+
+class _SlotsParser(HTMLParser):
+    """
+    Потоковый разбор страницы слотов без построения дерева.
+    Собирает блоки <div class="alert alert-success">: текст блока и
+    значение первого <input name="time"> внутри. Закрытие тегов повторяет
+    поведение BeautifulSoup: закрывающий тег закрывает все незакрытые
+    вложенные теги, лишние закрывающие теги игнорируются.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._results = []  # в порядке открытия блоков, как у find_all
+        self._stack = []  # имена открытых тегов
+        self._skip_text = 0  # сколько открыто script/style/template
+        self._open = []  # [позиция в стеке, индекс результата, input найден, value, части текста]
+        self._run = []  # текущий непрерывный фрагмент текста
+
+    @property
+    def slots(self):
+        return [result for result in self._results if result is not None]
+
+    def _flush_text(self):
+        if not self._run:
+            return
+        text = ''.join(self._run).strip()
+        self._run = []
+        if text and not self._skip_text:
+            for block in self._open:
+                block[4].append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        if tag in _VOID_TAGS:
+            self._handle_void(tag, attrs)
+            return
+        if tag in _SKIP_TEXT_TAGS:
+            self._skip_text += 1
+        elif tag == 'div':
+            classes = dict(attrs).get('class')
+            if classes and ' '.join(classes.split()) == 'alert alert-success':
+                self._open.append([len(self._stack), len(self._results), False, None, []])
+                self._results.append(None)
+        self._stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush_text()
+        if tag in _VOID_TAGS:
+            self._handle_void(tag, attrs)
+        else:
+            # <div ... /> открывается и сразу закрывается
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def _handle_void(self, tag, attrs):
+        if tag != 'input' or not self._open:
+            return
+        attrs = dict(attrs)
+        if attrs.get('name') == 'time':
+            for block in self._open:
+                if not block[2]:
+                    block[2] = True
+                    block[3] = attrs.get('value')
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        if tag not in self._stack:
+            return
+        position = len(self._stack) - 1 - self._stack[::-1].index(tag)
+        for closed in self._stack[position:]:
+            if closed in _SKIP_TEXT_TAGS:
+                self._skip_text -= 1
+        del self._stack[position:]
+        while self._open and self._open[-1][0] >= position:
+            self._close_block(self._open.pop())
+
+    def handle_data(self, data):
+        self._run.append(data)
+
+    def handle_comment(self, data):
+        self._flush_text()
+
+    handle_decl = handle_pi = unknown_decl = handle_comment
+
+    def _close_block(self, block):
+        position, index, input_found, value, text_parts = block
+        if input_found:
+            self._results[index] = (value, ' '.join(''.join(text_parts).split()))
+
+    def close(self):
+        super().close()
+        self._flush_text()
+        while self._open:
+            self._close_block(self._open.pop())
+
+
+class _FormParser(HTMLParser):
+    """Находит первый <input name="_token"> и action первой формы, затем останавливается"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.form_seen = False
+        self.action = None
+        self.token_seen = False
+        self.token = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'form' and not self.form_seen:
+            self.form_seen = True
+            self.action = dict(attrs).get('action')
+        elif tag == 'input' and not self.token_seen:
+            attrs = dict(attrs)
+            if attrs.get('name') == '_token':
+                self.token_seen = True
+                self.token = attrs.get('value')
+        if self.form_seen and self.token_seen:
+            raise _StopParsing()
+
+    handle_startendtag = handle_starttag
+
+
+def parse_slots(html):
+    """
+    Возвращает список (value, label) для доступных слотов —
+    то же, что давал разбор через BeautifulSoup.
+    """
+    if 'alert-success' not in html:
+        return []
+    parser = _SlotsParser()
+    parser.feed(html)
+    parser.close()
+    return parser.slots
+
+
+def parse_booking_form(html):
+    """Возвращает (csrf_token, form_action) со страницы формы; отсутствующие значения — None"""
+    parser = _FormParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except _StopParsing:
+        pass
+    return parser.token, parser.action
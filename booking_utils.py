@@ -1,152 +1,444 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import calendar
+import httpx
 import logging
 import re
+import time
 import datetime
 from urllib.parse import urljoin
-from config import BOOKING_BASE_URL
+from config import (
+    BOOKING_BASE_URL, SLOTS_CACHE_TTL, SLOTS_CACHE_MAX_SIZE, AVAILABILITY_CONCURRENCY,
+    AVAILABILITY_CACHE_TTL, AVAILABILITY_CACHE_STALE_TTL, AVAILABILITY_CACHE_MAX_SIZE, BOOKING_FORM_PREWARM_TTL,
+    SLOTS_RECHECK_MAX_AGE
+)
+from http_client import get_client, new_session, USER_AGENT
+from cache import TTLCache
+from booking_parser import parse_slots, parse_booking_form
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
+slots_cache = TTLCache("slots", ttl=SLOTS_CACHE_TTL, max_size=SLOTS_CACHE_MAX_SIZE)
 
-def fetch_available_slots(room_id, date_str):
+# Так сайт (Laravel) отвечает на POST с просроченным CSRF-токеном
+CSRF_EXPIRED_STATUS = 419
+
+# Ответы на POST заявки, после которых отправку можно повторить:
+# заявка не принята (перегрузка, режим обслуживания, недоступный бэкенд)
+RETRYABLE_STATUSES = {CSRF_EXPIRED_STATUS, 429, 502, 503}
+
+# Ошибки, при которых запрос не дошел до сайта
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Сводка свободных слотов зала за месяц для календаря бронирования
+availability_cache = TTLCache(
+    "availability",
+    ttl=AVAILABILITY_CACHE_TTL,
+    max_size=AVAILABILITY_CACHE_MAX_SIZE,
+    stale_ttl=AVAILABILITY_CACHE_STALE_TTL
+)
+
+
+async def fetch_available_slots(room_id, date_str):
     """Получает доступные временные слоты для бронирования"""
     try:
         params = {'room': room_id, 'date': date_str}
-        response = requests.get(BOOKING_BASE_URL, params=params)
+        response = await get_client().get(BOOKING_BASE_URL, params=params)
 
         if response.status_code != 200:
             logger.error(f"Ошибка при запросе слотов: {response.status_code}")
             return None
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        slots = []
+        # Блоки div.alert.alert-success с полем time; текст метки без лишних пробелов
+        with span("parse_slots"):
+            return parse_slots(response.text)
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении слотов: {e}")
+        return None
 
-        # Ищем все блоки с доступными слотами
-        alert_divs = soup.find_all('div', class_='alert alert-success')
 
-        for alert in alert_divs:
-            time_input = alert.find('input', {'name': 'time'})
-            if time_input:
-                value = time_input.get('value')
-                # Получаем текст метки, убирая лишние пробелы
-                label_text = alert.get_text(strip=True)
-                # Убираем возможные дублирования пробелов
-                label_text = ' '.join(label_text.split())
-                slots.append((value, label_text))
+async def fetch_available_slots_cached(room_id, date_str, fresh=False):
+    """
+    Доступные слоты через кэш по (зал, дата).
+    fresh=True игнорирует кэш и обновляет запись (перепроверка перед отправкой).
+    """
+    key = (int(room_id), date_str)
+    fetcher = lambda: fetch_available_slots(room_id, date_str)
+    if fresh:
+        return await slots_cache.refresh(key, fetcher)
+    return await slots_cache.get(key, fetcher)
 
-        return slots
 
-    except Exception as e:
-        logger.error(f"Ошибка при получении слотов: {e}")
+async def recheck_selected_slots(room_id, date_str, selected_slots, max_age=SLOTS_RECHECK_MAX_AGE):
+    """
+    Перепроверка выбранных слотов перед отправкой заявки.
+    Запись кэша моложе max_age секунд используется без запроса к сайту.
+    Возвращает (актуальные слоты, занятые из выбранных); (None, []), если слоты получить не удалось.
+    """
+    slots = slots_cache.peek((int(room_id), date_str), max_age=max_age)
+    if slots is None:
+        slots = await fetch_available_slots_cached(room_id, date_str, fresh=True)
+    if slots is None:
+        return None, []
+    available_values = {value for value, label in slots}
+    return slots, [slot for slot in selected_slots if slot not in available_values]
+
+
+def invalidate_slots(room_id, date_str):
+    """Сбрасывает кэш слотов для зала и даты (и сводку за месяц)"""
+    slots_cache.invalidate((int(room_id), date_str))
+    year, month = int(date_str[:4]), int(date_str[5:7])
+    availability_cache.invalidate((int(room_id), year, month))
+
+
+async def fetch_month_availability(room_id, year, month, concurrency=AVAILABILITY_CONCURRENCY):
+    """
+    Число свободных слотов зала на каждый еще не прошедший день месяца:
+    {день: количество или None, если данные не получены}.
+    Слоты запрашиваются параллельно через кэш слотов, поэтому выбор дня
+    после этого прохода не требует нового запроса к сайту.
+    Возвращает None, если не удалось получить ни одного дня.
+    """
+    today = datetime.date.today()
+    days = [
+        day for day in range(1, calendar.monthrange(year, month)[1] + 1)
+        if datetime.date(year, month, day) >= today
+    ]
+    if not days:
+        return {}
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def count_slots(day):
+        async with semaphore:
+            slots = await fetch_available_slots_cached(room_id, f"{year}-{month:02d}-{day:02d}")
+        return None if slots is None else len(slots)
+
+    counts = await asyncio.gather(*(count_slots(day) for day in days))
+    if all(count is None for count in counts):
         return None
+    return dict(zip(days, counts))
+
+
+async def fetch_month_availability_cached(room_id, year, month):
+    """Сводка fetch_month_availability через кэш (stale-while-revalidate)"""
+    key = (int(room_id), year, month)
+    return await availability_cache.get(key, lambda: fetch_month_availability(room_id, year, month))
+
+
+def booking_form_url(room_id, date_str, selected_slots):
+    """Адрес финальной страницы формы для выбранных слотов"""
+    return f"{BOOKING_BASE_URL}?room={room_id}&date={date_str}&time={','.join(selected_slots)}"
+
+
+async def _load_form(session, final_form_url):
+    """
+    GET the final form page and extract the CSRF token.
+    Returns (csrf_token, submit_url); the token is None if the page has no form.
+    """
+    logger.info(f"Fetching final booking form from: {final_form_url}")
+    get_response = await session.get(final_form_url)
+    get_response.raise_for_status()
+
+    with span("parse_booking_form"):
+        csrf_token, form_action = parse_booking_form(get_response.text)
+
+    if not csrf_token:
+        logger.error(f"Could not find CSRF token on the final booking page: {final_form_url}")
+        logger.error(f"Page content received: {get_response.text[:500]}")
+        return None, None
+
+    logger.info(f"Found CSRF token on final page: {csrf_token[:10]}...")
+
+    # Find the actual submit URL from the form's action attribute
+    submit_url = urljoin(BOOKING_BASE_URL, form_action) if form_action else BOOKING_BASE_URL
+    return csrf_token, submit_url
+
+
+class PreparedForm:
+    """Сессия сайта с уже загруженной формой бронирования и CSRF-токеном"""
+    __slots__ = ('session', 'token', 'submit_url', 'prepared_at')
+
+    def __init__(self, session, token, submit_url):
+        self.session = session
+        self.token = token
+        self.submit_url = submit_url
+        self.prepared_at = time.monotonic()
+
+    def is_fresh(self, ttl):
+        return time.monotonic() - self.prepared_at < ttl
+
+    async def close(self):
+        await self.session.aclose()
+
+
+class FormPrewarmer:
+    """
+    Загружает форму бронирования (GET и CSRF-токен) в фоне, пока пользователь
+    читает сводку заявки, чтобы подтверждение стоило только одного POST.
+    Подготовленная сессия хранится в памяти не дольше ttl секунд и
+    используется один раз; данные пользователя в нее не попадают.
+    """
+
+    def __init__(self, ttl=BOOKING_FORM_PREWARM_TTL):
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (ключ формы, задача подготовки)
+        self.used = 0
+        self.missed = 0
+
+    @staticmethod
+    def _key(room_id, date_str, selected_slots):
+        return int(room_id), date_str, tuple(selected_slots)
+
+    def _is_stale(self, task):
+        if not task.done():
+            return False
+        prepared = task.result()
+        return prepared is None or not prepared.is_fresh(self.ttl)
+
+    def start(self, user_id, room_id, date_str, selected_slots):
+        """Начинает подготовку формы; уже подготовленная для тех же слотов сохраняется"""
+        key = self._key(room_id, date_str, selected_slots)
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] == key and not self._is_stale(entry[1]):
+            return
 
+        self.discard(user_id)
+        for other_user_id, (_, task) in list(self._entries.items()):
+            if self._is_stale(task):
+                self.discard(other_user_id)
 
-def submit_booking(room_id, room_name, date_str, selected_slots, all_slots, user_name, phone_number, comment):
+        task = asyncio.ensure_future(self._prepare(room_id, date_str, selected_slots))
+        self._entries[user_id] = (key, task)
+
+    async def _prepare(self, room_id, date_str, selected_slots):
+        session = new_session()
+        try:
+            token, submit_url = await _load_form(session, booking_form_url(room_id, date_str, selected_slots))
+        except Exception as e:
+            logger.warning(f"Не удалось заранее загрузить форму бронирования: {e!r}")
+            token = None
+        if not token:
+            await session.aclose()
+            return None
+        return PreparedForm(session, token, submit_url)
+
+    def detach(self, user_id, room_id, date_str, selected_slots):
+        """
+        Забирает подготовку формы для этих слотов, не дожидаясь ее: задача для
+        resolve() или None. Подготовка для других слотов отбрасывается.
+        """
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return None
+        if entry[0] != self._key(room_id, date_str, selected_slots):
+            asyncio.ensure_future(self._close(entry[1]))
+            return None
+        return entry[1]
+
+    async def resolve(self, task):
+        """Дожидается подготовки из detach(); None, если формы нет или она устарела"""
+        prepared = await task if task is not None else None
+        if prepared is not None and not prepared.is_fresh(self.ttl):
+            await prepared.close()
+            prepared = None
+
+        if prepared is None:
+            self.missed += 1
+        else:
+            self.used += 1
+        return prepared
+
+    async def take(self, user_id, room_id, date_str, selected_slots):
+        """Подготовленная форма для этих слотов или None; дождется подготовки, если она еще идет"""
+        return await self.resolve(self.detach(user_id, room_id, date_str, selected_slots))
+
+    def drop(self, task):
+        """Закрывает форму из detach(), которая не понадобилась; возвращает задачу закрытия"""
+        return asyncio.ensure_future(self._close(task))
+
+    def discard(self, user_id):
+        """Отбрасывает подготовленную форму пользователя (отмена, новые слоты)"""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            asyncio.ensure_future(self._close(entry[1]))
+
+    @staticmethod
+    async def _close(task):
+        prepared = await task
+        if prepared is not None:
+            await prepared.close()
+
+    async def close_all(self):
+        entries, self._entries = self._entries, {}
+        await asyncio.gather(*(self._close(task) for _, task in entries.values()), return_exceptions=True)
+
+    def stats(self):
+        return {'pending': len(self._entries), 'used': self.used, 'missed': self.missed}
+
+
+form_prewarmer = FormPrewarmer()
+
+
+class RetryableSubmissionError(Exception):
+    """
+    The booking was not accepted because of a temporary error and can be sent again.
+    ``maybe_sent`` is True when the POST may have reached the site (e.g. the
+    response was lost), so a retry has to make sure the booking did not land.
+    """
+
+    def __init__(self, reason, maybe_sent=False):
+        super().__init__(reason)
+        self.maybe_sent = maybe_sent
+
+
+async def submit_booking(room_id, room_name, date_str, selected_slots, all_slots, user_name, phone_number, comment,
+                         prepared=None, raise_retryable=False):
     """
     Submits the booking to the website by navigating to the final form page
     and then sending a POST request with a CSRF token.
+    ``prepared`` (from form_prewarmer) skips the GET; if its token is rejected
+    as expired, the whole sequence is repeated with a new session.
+    With ``raise_retryable`` temporary failures raise RetryableSubmissionError
+    instead of being reported as a failed submission (used by the submission queue).
     Returns a tuple (success: bool, message: str).
     """
-    submit_url = BOOKING_BASE_URL
+    try:
+        return await _submit_booking(room_id, room_name, date_str, selected_slots, all_slots, user_name,
+                                     phone_number, comment, prepared)
+    except RetryableSubmissionError as e:
+        if raise_retryable:
+            raise
+        logger.error(f"A network error occurred during booking submission: {e}")
+        return False, f"Произошла сетевая ошибка при отправке заявки."
+
+
+async def _submit_booking(room_id, room_name, date_str, selected_slots, all_slots, user_name, phone_number, comment,
+                          prepared):
     time_str_for_get = ",".join(selected_slots)
-    final_form_url = f"{BOOKING_BASE_URL}?room={room_id}&date={date_str}&time={time_str_for_get}"
+    final_form_url = booking_form_url(room_id, date_str, selected_slots)
+    payload = {
+        'room': room_id,
+        'date': date_str,
+        'time': time_str_for_get,
+        'name': user_name,
+        'phone': phone_number,
+        'comment': comment,
+        'rules': 'on', # This was the missing required field
+        'submit': '',
+    }
 
-    with requests.Session() as session:
+    if prepared is not None:
         try:
-            # Step 1: GET request to the final form page to get the CSRF token
-            logger.info(f"Fetching final booking form from: {final_form_url}")
-            get_response = session.get(final_form_url, headers={'User-Agent': 'TelegramBookingBot/1.0'})
-            get_response.raise_for_status()
-
-            soup = BeautifulSoup(get_response.text, 'html.parser')
-            token_input = soup.find('input', {'name': '_token'})
+            post_response = await _post_booking(prepared.session, prepared.submit_url, prepared.token,
+                                                payload, final_form_url)
+            if post_response.status_code == CSRF_EXPIRED_STATUS:
+                logger.info("Prepared CSRF token was rejected as expired, loading the form again")
+            else:
+                return _booking_result(post_response, room_id, room_name, date_str, selected_slots, all_slots, user_name)
+        except httpx.ConnectError as e:
+            # The request never reached the site, so it is safe to start over
+            logger.info(f"Prepared session could not connect ({e!r}), loading the form again")
+        except httpx.HTTPError as e:
+            raise RetryableSubmissionError(repr(e), maybe_sent=True) from e
+        except RetryableSubmissionError:
+            raise
+        except Exception as e:
+            logger.error(f"An unexpected error occurred in submit_booking: {e}", exc_info=True)
+            return False, "Произошла непредвиденная ошибка при отправке бронирования."
+        finally:
+            await prepared.close()
 
-            if not token_input or not token_input.get('value'):
-                logger.error(f"Could not find CSRF token on the final booking page: {final_form_url}")
-                logger.error(f"Page content received: {get_response.text[:500]}")
+    async with new_session() as session:
+        try:
+            # Step 1: GET request to the final form page to get the CSRF token
+            try:
+                csrf_token, submit_url = await _load_form(session, final_form_url)
+            except httpx.HTTPError as e:
+                # Nothing has been submitted yet
+                raise RetryableSubmissionError(repr(e)) from e
+            if not csrf_token:
                 return False, "Не удалось найти CSRF-токен на финальной странице бронирования. Возможно, выбранные слоты уже заняты."
 
-            csrf_token = token_input.get('value')
-            logger.info(f"Found CSRF token on final page: {csrf_token[:10]}...")
-
-            # Find the actual submit URL from the form's action attribute
-            form = soup.find('form')
-            if form and form.get('action'):
-                submit_url = urljoin(BOOKING_BASE_URL, form.get('action'))
-
             # Step 2: POST request to submit the booking
-            payload = {
-                '_token': csrf_token,
-                'room': room_id,
-                'date': date_str,
-                'time': time_str_for_get,
-                'name': user_name,
-                'phone': phone_number,
-                'comment': comment,
-                'rules': 'on', # This was the missing required field
-                'submit': '',
-            }
-
-            logger.info(f"Submitting booking to {submit_url} for room {room_id}")
-            post_response = session.post(
-                submit_url,
-                data=payload,
-                headers={'User-Agent': 'TelegramBookingBot/1.0', 'Referer': final_form_url}
-            )
-
-            # A successful submission contains the phrase "Благодарим за Ваш выбор"
-            if post_response.ok and "Благодарим за Ваш выбор" in post_response.text:
-                logger.info(f"Booking submission successful with status {post_response.status_code}.")
-
-                # --- Construct the detailed success message ---
-
-                # 1. Format date with Russian names
-                try:
-                    date_obj = datetime.datetime.strptime(date_str, '%Y-%m-%d')
-                    # Define Russian locale names
-                    days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-                    months = ["", "Января", "Февраля", "Марта", "Апреля", "Мая", "Июня", "Июля", "Августа", "Сентября", "Октября", "Ноября", "Декабря"]
-                    day_of_week = days[date_obj.weekday()]
-                    month_name = months[date_obj.month]
-                    formatted_date = f"{day_of_week}, {date_obj.day}, {month_name}, {date_obj.year}"
-                except (ValueError, TypeError):
-                    formatted_date = date_str # Fallback
-
-                # 2. Find selected slots' labels and calculate total price
-                total_price = 0
-                selected_labels = []
-                for slot_value in selected_slots:
-                    for value, label in all_slots:
-                        if value == slot_value:
-                            selected_labels.append(label)
-                            price_match = re.search(r'\(₽(\d+)\)', label)
-                            if price_match:
-                                total_price += int(price_match.group(1))
-                            break
-
-                intervals_text = "\n".join(selected_labels)
-
-                # 3. Construct the final message
-                success_message = (
-                    f"Уважаемый {user_name}!\n"
-                    f"Ваша заявка на {formatted_date}\n"
-                    f"Интервалы: {intervals_text}\n"
-                    f"Общей стоимостью: ₽ {total_price}\n"
-                    f"Зал: {room_name}.\n\n"
-                    "ВНИМАНИЕ! При бронировании менее чем за СУТКИ, обязательно свяжитесь с АДМИНИСТРАЦИЕЙ "
-                    "по телефону +7-8142-63-53-93 или +7-911-400-53-63 для подтверждения свободного ВРЕМЕНИ! "
-                    "При ОТМЕНЕ менее, чем за ДВОЕ суток - неустойка (50% от полной суммы бронирования)!"
-                )
-
-                return True, success_message
-            else:
-                logger.error(f"Booking submission failed. Status: {post_response.status_code}, URL: {post_response.url}, Response: {post_response.text[:300]}")
-                return False, f"Ошибка при отправке заявки. Сервер ответил со статусом: {post_response.status_code}."
+            try:
+                post_response = await _post_booking(session, submit_url, csrf_token, payload, final_form_url)
+            except _NOT_SENT_ERRORS as e:
+                raise RetryableSubmissionError(repr(e)) from e
+            except httpx.HTTPError as e:
+                # The request may have been processed even though the response was lost
+                raise RetryableSubmissionError(repr(e), maybe_sent=True) from e
+            return _booking_result(post_response, room_id, room_name, date_str, selected_slots, all_slots, user_name)
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"A network error occurred during booking submission: {e}")
-            return False, f"Произошла сетевая ошибка при отправке заявки."
+        except RetryableSubmissionError:
+            raise
         except Exception as e:
             logger.error(f"An unexpected error occurred in submit_booking: {e}", exc_info=True)
-            return False, "Произошла непредвиденная ошибка при отправке бронирования."
\ No newline at end of file
+            return False, "Произошла непредвиденная ошибка при отправке бронирования."
+
+
+async def _post_booking(session, submit_url, csrf_token, payload, final_form_url):
+    logger.info(f"Submitting booking to {submit_url} for room {payload['room']}")
+    return await session.post(
+        submit_url,
+        data={'_token': csrf_token, **payload},
+        headers={'User-Agent': USER_AGENT, 'Referer': final_form_url}
+    )
+
+
+def _booking_result(post_response, room_id, room_name, date_str, selected_slots, all_slots, user_name):
+    """Turns the response to the booking POST into (success, message)."""
+    if post_response.status_code in RETRYABLE_STATUSES:
+        raise RetryableSubmissionError(f"status {post_response.status_code}")
+
+    # A successful submission contains the phrase "Благодарим за Ваш выбор"
+    if post_response.is_success and "Благодарим за Ваш выбор" in post_response.text:
+        logger.info(f"Booking submission successful with status {post_response.status_code}.")
+        # The booked slots are gone now, drop the cached availability
+        invalidate_slots(room_id, date_str)
+
+        # --- Construct the detailed success message ---
+
+        # 1. Format date with Russian names
+        try:
+            date_obj = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+            # Define Russian locale names
+            days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+            months = ["", "Января", "Февраля", "Марта", "Апреля", "Мая", "Июня", "Июля", "Августа", "Сентября", "Октября", "Ноября", "Декабря"]
+            day_of_week = days[date_obj.weekday()]
+            month_name = months[date_obj.month]
+            formatted_date = f"{day_of_week}, {date_obj.day}, {month_name}, {date_obj.year}"
+        except (ValueError, TypeError):
+            formatted_date = date_str # Fallback
+
+        # 2. Find selected slots' labels and calculate total price
+        total_price = 0
+        selected_labels = []
+        for slot_value in selected_slots:
+            for value, label in all_slots:
+                if value == slot_value:
+                    selected_labels.append(label)
+                    price_match = re.search(r'\(₽(\d+)\)', label)
+                    if price_match:
+                        total_price += int(price_match.group(1))
+                    break
+
+        intervals_text = "\n".join(selected_labels)
+
+        # 3. Construct the final message
+        success_message = (
+            f"Уважаемый {user_name}!\n"
+            f"Ваша заявка на {formatted_date}\n"
+            f"Интервалы: {intervals_text}\n"
+            f"Общей стоимостью: ₽ {total_price}\n"
+            f"Зал: {room_name}.\n\n"
+            "ВНИМАНИЕ! При бронировании менее чем за СУТКИ, обязательно свяжитесь с АДМИНИСТРАЦИЕЙ "
+            "по телефону +7-8142-63-53-93 или +7-911-400-53-63 для подтверждения свободного ВРЕМЕНИ! "
+            "При ОТМЕНЕ менее, чем за ДВОЕ суток - неустойка (50% от полной суммы бронирования)!"
+        )
+
+        return True, success_message
+    else:
+        logger.error(f"Booking submission failed. Status: {post_response.status_code}, URL: {post_response.url}, Response: {post_response.text[:300]}")
+        return False, f"Ошибка при отправке заявки. Сервер ответил со статусом: {post_response.status_code}."
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Асинхронный кэш с TTL, ограничением размера (LRU) и stale-while-revalidate.
+
+    Запись считается свежей ``ttl`` секунд. Следующие ``stale_ttl`` секунд
+    она отдается сразу, а в фоне запускается обновление. Результат ``None``
+    (ошибка загрузки) не кэшируется.
+    """
+
+    def __init__(self, name, ttl, max_size, stale_ttl=0):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._inflight = {}  # key -> asyncio.Task
+        self._requested = {}  # key -> время последнего запроса через get()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, key, fetcher):
+        """Запускает загрузку ключа, объединяя параллельные запросы"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, fetcher))
+            self._inflight[key] = task
+        return task
+
+    async def _run(self, key, fetcher):
+        try:
+            value = await fetcher()
+            if value is not None:
+                self._store(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    async def get(self, key, fetcher):
+        """Возвращает значение из кэша или загружает его через ``fetcher()``"""
+        self._requested[key] = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if key not in self._inflight:
+                    self.refreshes += 1
+                    self._load(key, fetcher).add_done_callback(self._log_refresh_error)
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        return await asyncio.shield(self._load(key, fetcher))
+
+    async def refresh(self, key, fetcher):
+        """Принудительно обновляет запись (например, из фоновой задачи)"""
+        self.refreshes += 1
+        return await asyncio.shield(self._load(key, fetcher))
+
+    def peek(self, key, max_age=None):
+        """
+        Возвращает значение без загрузки и без учета в статистике.
+        max_age — вернуть значение, только если оно загружено не раньше стольких секунд назад.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        age = time.monotonic() - entry[0]
+        if age >= self.ttl + self.stale_ttl or (max_age is not None and age >= max_age):
+            return None
+        return entry[1]
+
+    def requested_within(self, seconds):
+        """Ключи, запрошенные через get() за последние seconds секунд (для фоновой предзагрузки)"""
+        threshold = time.monotonic() - seconds
+        self._requested = {key: at for key, at in self._requested.items() if at >= threshold}
+        return set(self._requested)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'name': self.name,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'hit_ratio': round((self.hits + self.stale_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+    def _log_refresh_error(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка фонового обновления кэша {self.name}: {task.exception()}")
@@ -1,3 +1,4 @@
+import os
 from telegram import KeyboardButton
 
 # Конфигурационные константы
@@ -19,8 +20,128 @@ ROOM_NAMES = {
     5: '"Гитарные покои" РОК-школы "Z-school"',
 }
 
-API_BASE_URL = "https://deadprogrammer.ru/all"
-BOOKING_BASE_URL = "https://xn--80abgqdco6d4e.xn--p1ai/book"
+# Адреса внешних сервисов; переменные окружения позволяют направить бота
+# на локальный эмулятор (benchmarks/upstream_emulator.py)
+API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://deadprogrammer.ru/all")
+BOOKING_BASE_URL = os.environ.get("BOT_BOOKING_BASE_URL", "https://xn--80abgqdco6d4e.xn--p1ai/book")
+
+# Настройки HTTP-клиента (секунды / количество соединений)
+HTTP_TIMEOUT = 15
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE = 10
+
+# Кэш расписания (секунды / количество дат)
+SCHEDULE_CACHE_TTL = 60
+SCHEDULE_CACHE_STALE_TTL = 600
+SCHEDULE_CACHE_MAX_SIZE = 64
+
+# Кэш доступных слотов по (зал, дата); устаревшие слоты не отдаются
+SLOTS_CACHE_TTL = 90
+SLOTS_CACHE_MAX_SIZE = 256
+
+# Фоновая предзагрузка расписания и слотов на ближайшие дни
+PREFETCH_ENABLED = True
+PREFETCH_DAYS = 3
+PREFETCH_INTERVAL = 60
+PREFETCH_CONCURRENCY = 3
+PREFETCH_JITTER = 2.0
+# True — обновлять только даты и залы, которые запрашивали за последние
+# PREFETCH_REQUESTED_WINDOW секунд (первый запрос остальных пойдет на сайт)
+PREFETCH_REQUESTED_ONLY = False
+PREFETCH_REQUESTED_WINDOW = 900
+
+# Получение обновлений. При DROP_PENDING_UPDATES = False обновления,
+# пришедшие пока бот был остановлен, обрабатываются после запуска
+DROP_PENDING_UPDATES = False
+UPDATE_QUEUE_SIZE = 1000
+
+# Сколько обновлений обрабатывается одновременно (0 — последовательно).
+# Обновления одного пользователя всегда обрабатываются по порядку
+UPDATE_WORKERS = 8
+
+# Режим webhook вместо long polling (см. webhook.py)
+WEBHOOK_ENABLED = False
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""  # Публичный адрес, например "https://bot.example.com/telegram"; обязателен с WEBHOOK_SET_ON_START
+WEBHOOK_SECRET_TOKEN = ""  # Пустая строка — случайный токен при каждом запуске (только с WEBHOOK_SET_ON_START)
+WEBHOOK_SET_ON_START = True  # False — не регистрировать webhook в Telegram (локальная проверка)
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Ограничения исходящих сообщений Telegram
+RATE_LIMIT_GLOBAL_PER_SECOND = 30
+RATE_LIMIT_PRIVATE_PER_SECOND = 1
+RATE_LIMIT_GROUP_PER_MINUTE = 20
+RATE_LIMIT_CHAT_BURST = 3
+RATE_LIMIT_MAX_RETRIES = 3
+
+# Недельный вид расписания: число дней, параллельных запросов к API
+# и часы, которые показывает сетка занятости
+WEEK_VIEW_DAYS = 7
+SCHEDULE_FETCH_CONCURRENCY = 4
+WEEK_GRID_FIRST_HOUR = 8
+WEEK_GRID_LAST_HOUR = 24
+
+# Подсказка о свободных слотах в календаре бронирования: число параллельных
+# запросов за месяц, время жизни сводки (секунды) и сколько ждать ее перед
+# показом календаря (дальше календарь обновится, когда сводка будет готова)
+CALENDAR_AVAILABILITY_ENABLED = True
+AVAILABILITY_CONCURRENCY = 4
+AVAILABILITY_CACHE_TTL = 300
+AVAILABILITY_CACHE_STALE_TTL = 1800
+AVAILABILITY_CACHE_MAX_SIZE = 32
+CALENDAR_AVAILABILITY_WAIT = 2
+
+# Метрики в формате Prometheus: GET http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9100
+
+# Трассировка: обновления дольше порога (секунды) пишутся в лог с разбивкой
+# по участкам. Выборочное профилирование cProfile медленных обновлений
+# (можно включить командой /profiling on)
+SLOW_UPDATE_THRESHOLD = 2.0
+PROFILE_SLOW_UPDATES = False
+PROFILE_SAMPLE_RATE = 0.05
+PROFILE_DIR = "data/profiles"
+PROFILE_MAX_FILES = 200
+
+# Заранее загружать форму бронирования (CSRF-токен), пока пользователь
+# проверяет сводку заявки; сколько секунд хранить подготовленную форму
+BOOKING_FORM_PREWARM = True
+BOOKING_FORM_PREWARM_TTL = 600
+
+# Перед отправкой заявки выбранные слоты перепроверяются; запись кэша слотов
+# моложе стольких секунд используется без повторного запроса к сайту
+SLOTS_RECHECK_MAX_AGE = 15
+
+# Очередь отправки заявок на сайт (таблица booking_submissions в базе бота).
+# Пользователь сразу получает «принято», результат приходит отдельным сообщением.
+# Задержка перед повтором удваивается с каждой попыткой (не больше MAX_DELAY), секунды;
+# одинаковая заявка, отправленная в течение DEDUP_WINDOW секунд, повторно не ставится
+SUBMISSION_QUEUE_ENABLED = True
+SUBMISSION_CONCURRENCY = 2
+SUBMISSION_MAX_ATTEMPTS = 6
+SUBMISSION_RETRY_BASE_DELAY = 5
+SUBMISSION_RETRY_MAX_DELAY = 300
+SUBMISSION_POLL_INTERVAL = 5
+SUBMISSION_DEDUP_WINDOW = 3600
+SUBMISSION_KEEP_DAYS = 30
+
+# Сколько построенных клавиатур-календарей держать в памяти
+CALENDAR_CACHE_SIZE = 256
+
+# Хранилище состояния бота (SQLite). При PERSISTENCE_WRITE_INTERVAL > 0
+# изменения копятся в памяти и записываются одной транзакцией
+PERSISTENCE_PATH = "data/bot.db"
+PERSISTENCE_WRITE_INTERVAL = 5
+PERSISTENCE_MAX_PENDING_WRITES = 500
+
+# Отправлять расписание минимальным числом сообщений (до 4096 символов)
+# вместо отдельного сообщения на каждое бронирование
+SCHEDULE_BATCH_MESSAGES = True
 
 # Главное меню
 MAIN_MENU_KEYBOARD = [
@@ -1,4 +1,5 @@
-from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram import Update, CallbackQuery, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.constants import MessageLimit
 from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
@@ -12,10 +13,27 @@ import asyncio
 import logging
 import re
 import json
-from keyboards import generate_room_selection, generate_calendar
-from api_utils import fetch_bookings, extract_times, get_start_time
-from booking_utils import fetch_available_slots, submit_booking
-from config import ROOM_NAMES, ADMIN_USER_IDS, ROOM_ADMINS, API_BASE_URL, MAIN_MENU_KEYBOARD, BOOKING_BASE_URL
+import html
+import sqlite3
+from keyboards import (
+    generate_room_selection, generate_calendar, generate_week_navigation, RUSSIAN_WEEKDAY_NAMES, FULL_DAY_MARK
+)
+from permissions import permissions
+from rate_limiter import BULK, StaleRequest
+from metrics import handler_latency
+from tracing import profiler
+from api_utils import fetch_bookings_cached, fetch_bookings_for_dates, schedule_cache, Booking
+from booking_utils import (
+    fetch_available_slots_cached, fetch_month_availability_cached, submit_booking, slots_cache,
+    availability_cache, form_prewarmer, recheck_selected_slots
+)
+from submission_queue import submission_queue
+from config import (
+    ROOM_NAMES, API_BASE_URL, MAIN_MENU_KEYBOARD, BOOKING_BASE_URL,
+    SCHEDULE_BATCH_MESSAGES, PERSISTENCE_PATH, WEEK_VIEW_DAYS, WEEK_GRID_FIRST_HOUR,
+    WEEK_GRID_LAST_HOUR, CALENDAR_AVAILABILITY_ENABLED, CALENDAR_AVAILABILITY_WAIT, BOOKING_FORM_PREWARM,
+    SUBMISSION_QUEUE_ENABLED
+)
 
 # Инициализация логгера
 logger = logging.getLogger(__name__)
@@ -162,21 +180,44 @@ async def show_calendar(
             room_name = ROOM_NAMES.get(int(selected_room), selected_room)
             text += f" зала {room_name}"
 
-        reply_markup = generate_calendar(
+        # Поколение календаря: позднее обновление сводки не должно затереть
+        # сообщение, если пользователь уже ушел с этого календаря
+        generation = _invalidate_calendar(context, user_id)
+
+        availability = None
+        pending = None
+        if purpose == "booking" and CALENDAR_AVAILABILITY_ENABLED and selected_room and selected_room != "all":
+            pending = asyncio.ensure_future(fetch_month_availability_cached(selected_room, year, month))
+            try:
+                availability = await asyncio.wait_for(asyncio.shield(pending), CALENDAR_AVAILABILITY_WAIT)
+                pending = None
+            except asyncio.TimeoutError:
+                pass
+
+        calendar_args = dict(
             year=year,
             month=month,
             selected_room=selected_room,
             user_id=user_id,
             room_names=ROOM_NAMES,
-            admin_ids=ADMIN_USER_IDS,
-            room_admins=ROOM_ADMINS,
             purpose=purpose
         )
+        reply_markup = generate_calendar(**calendar_args, availability=availability)
 
+        message = None
         if isinstance(update, Update) and update.message:
-            await update.message.reply_text(text, reply_markup=reply_markup)
+            message = await update.message.reply_text(_with_legend(text, availability), reply_markup=reply_markup)
         elif isinstance(update, CallbackQuery):
-            await update.edit_message_text(text, reply_markup=reply_markup)
+            message = await update.edit_message_text(_with_legend(text, availability), reply_markup=reply_markup)
+
+        if pending is not None and isinstance(message, Message):
+            task = context.application.create_task(
+                _show_availability_when_ready(context, message, text, calendar_args, pending, generation)
+            )
+            _availability_redraws[user_id] = task
+            task.add_done_callback(
+                lambda done: _availability_redraws.pop(user_id) if _availability_redraws.get(user_id) is done else None
+            )
     except Exception as e:
         logger.error(f"Ошибка при показе календаря: {e}")
         if isinstance(update, Update) and update.message:
@@ -185,6 +226,48 @@ async def show_calendar(
             await update.answer("⚠️ Не удалось открыть календарь")
 
 
+# Отложенные дорисовки сводки в календарь: user_id -> задача
+_availability_redraws = {}
+
+
+def _invalidate_calendar(context, user_id):
+    """
+    Показанный календарь больше не актуален: новое поколение и отмена его
+    отложенной дорисовки. Возвращает новое поколение.
+    """
+    generation = context.user_data.get('calendar_generation', 0) + 1
+    context.user_data['calendar_generation'] = generation
+    task = _availability_redraws.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+    return generation
+
+
+def _with_legend(text, availability):
+    if not availability:
+        return text
+    return f"{text}\n\n¹²³ — свободных слотов в этот день, {FULL_DAY_MARK} — мест нет"
+
+
+async def _show_availability_when_ready(context, message, text, calendar_args, pending, generation):
+    """Дорисовывает сводку свободных слотов в уже показанный календарь"""
+    try:
+        availability = await pending
+        is_current = lambda: context.user_data.get('calendar_generation') == generation
+        if not availability or not is_current():
+            return
+        # Правка может ждать в ограничителе запросов; поколение проверяется еще раз перед отправкой
+        await message.edit_text(
+            _with_legend(text, availability),
+            reply_markup=generate_calendar(**calendar_args, availability=availability),
+            rate_limit_args={'still_current': is_current}
+        )
+    except StaleRequest:
+        pass
+    except Exception as e:
+        logger.warning(f"Не удалось показать свободные слоты в календаре: {e}")
+
+
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает справку"""
     help_text = (
@@ -192,7 +275,8 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "1. Используйте кнопку \"Просмотр расписания\" для просмотра занятости помещений\n"
         "2. Затем выберите зал и дату в календаре\n"
         "3. Бот покажет все бронирования на выбранную дату\n"
-        "4. Для навигации по месяцам используйте кнопки \"⬅️\" и \"➡️\"\n\n"
+        "4. Для навигации по месяцам используйте кнопки \"⬅️\" и \"➡️\"\n"
+        "5. Кнопка \"📆 Сетка на неделю\" покажет занятость залов по часам на 7 дней\n\n"
         "**Бронирование:**\n"
         "- Выберите пункт \"Бронировать\", затем зал, дату и доступные слоты\n"
         "- После выбора слотов вы получите ссылку для оформления брони на сайте\n\n"
@@ -280,10 +364,7 @@ async def handle_callback(
             year, month, day = int(parts[1]), int(parts[2]), int(parts[3])
             selected_room = context.user_data.get('selected_room', 'all')
 
-            is_admin = user_id in ADMIN_USER_IDS or any(
-                user_id in ROOM_ADMINS.get(rid, [])
-                for rid in ROOM_ADMINS
-            )
+            is_admin = permissions.is_admin(user_id)
             selected_date = datetime.datetime(year, month, day)
 
             if not is_admin and selected_date.date() < datetime.datetime.now().date():
@@ -292,7 +373,7 @@ async def handle_callback(
 
             date_str = f"{year}{month:02d}{day:02d}"
             await query.edit_message_text(f"⏳ Ищу бронирования на {day}.{month}.{year}...")
-            bookings = fetch_bookings(date_str, API_BASE_URL)
+            bookings = await fetch_bookings_cached(date_str, API_BASE_URL)
 
             if bookings is None:
                 await query.edit_message_text("❌ Не удалось получить данные с сервера. Попробуйте позже.")
@@ -306,6 +387,13 @@ async def handle_callback(
                 selected_room
             )
 
+        elif data.startswith("week_"):
+            parts = data.split("_")
+            start_date = datetime.datetime.strptime(parts[1], "%Y%m%d").date()
+            selected_room = parts[2] if len(parts) > 2 else "all"
+            context.user_data['selected_room'] = selected_room
+            await show_week(query, context, start_date, selected_room, user_id)
+
         elif data.startswith("prev_") or data.startswith("next_"):
             parts = data.split("_")
             year, month = int(parts[1]), int(parts[2])
@@ -338,6 +426,216 @@ async def handle_callback(
             )
 
 
+def format_booking(index: int, booking: Booking, show_details: bool) -> str:
+    """Формирует текст одного бронирования"""
+    message_parts = []
+
+    if booking.is_cancelled:
+        message_parts.append("🟨🟨🟨 [ОТМЕНЕНО] 🟨🟨🟨")
+
+    message_parts.append(f"#{index}: {booking.name}")
+
+    if show_details:
+        message_parts.append(f"📞: {booking.phone}")
+
+    if booking.times_text:
+        message_parts.append(f"🕒: {booking.times_text}")
+
+    message_parts.append(f"Статус: {booking.status.capitalize()}")
+
+    if show_details and booking.comment:
+        message_parts.append(f"💬: {booking.comment}")
+
+    if booking.is_cancelled:
+        message_parts.append("🟨🟨🟨 ОТМЕНЕНО 🟨🟨🟨")
+
+    return "\n".join(message_parts)
+
+
+def build_booking_messages(bookings: list, user_id: int, selected_room: str) -> list:
+    """
+    Собирает тексты для списка бронирований: общий заголовок,
+    заголовок каждого зала и по одному блоку на бронирование.
+    """
+    bookings_by_room = {}
+    for booking in bookings:
+        room_id = booking.room_id
+        if room_id not in bookings_by_room:
+            bookings_by_room[room_id] = []
+        bookings_by_room[room_id].append(booking)
+
+    total_count = len(bookings)
+    room_count = len(bookings_by_room)
+
+    if selected_room and selected_room != "all":
+        room_name = ROOM_NAMES.get(int(selected_room), f"зал {selected_room}")
+        header = f"📋 Найдено {total_count} бронирований в {room_name}:"
+    else:
+        header = f"📋 Найдено {total_count} бронирований в {room_count} залах:"
+
+    blocks = [header]
+
+    for room_id, room_bookings in sorted(bookings_by_room.items()):
+        room_name = ROOM_NAMES.get(room_id, f"Зал {room_id}")
+        show_details = permissions.can_see_details(user_id, room_id)
+
+        room_header = f"🚪 {room_name} ({len(room_bookings)} бронир.)"
+        if show_details:
+            room_header += " 👑"
+        blocks.append(room_header)
+
+        sorted_room_bookings = sorted(room_bookings, key=lambda b: b.sort_key)
+
+        for i, booking in enumerate(sorted_room_bookings, 1):
+            try:
+                blocks.append(format_booking(i, booking, show_details))
+            except Exception as e:
+                logger.error(f"Ошибка при формировании бронирования: {e}")
+                blocks.append(f"⚠️ Ошибка при отображении бронирования #{i}")
+
+    return blocks
+
+
+def _occupied_hours(bookings: list) -> set:
+    """Часы суток, которые хотя бы частично заняты неотмененными бронированиями"""
+    hours = set()
+    for booking in bookings:
+        if booking.is_cancelled or booking.start_minutes is None:
+            continue
+        end_minutes = max(booking.end_minutes, booking.start_minutes + 1)
+        hours.update(range(booking.start_minutes // 60, (end_minutes - 1) // 60 + 1))
+    return hours
+
+
+def build_week_grid(start_date: datetime.date, bookings_by_date: dict, selected_room: str) -> list:
+    """
+    Сетка занятости залов по дням и часам: заголовок и по блоку на зал
+    (HTML для parse_mode="HTML").
+    bookings_by_date: {date: список Booking или None, если данные не получены}.
+    """
+    hours = range(WEEK_GRID_FIRST_HOUR, WEEK_GRID_LAST_HOUR)
+    dates = sorted(bookings_by_date)
+    end_date = dates[-1]
+
+    if selected_room and selected_room != "all":
+        room_ids = [int(selected_room)]
+    else:
+        room_ids = set(ROOM_NAMES)
+        for bookings in bookings_by_date.values():
+            room_ids.update(booking.room_id for booking in bookings or ())
+        room_ids = sorted(room_ids, key=lambda room_id: (not isinstance(room_id, int), str(room_id)))
+
+    # Метки часов над сеткой: каждые 4 часа
+    label_width = len("Пн 01.01 ")
+    scale = [" "] * len(hours)
+    for position, hour in enumerate(hours):
+        if hour % 4 == 0 and position + len(str(hour)) <= len(scale):
+            scale[position:position + len(str(hour))] = str(hour)
+    scale_line = (" " * label_width + "".join(scale)).rstrip()
+
+    parts = [
+        f"📆 Занятость с {start_date:%d.%m} по {end_date:%d.%m}\n"
+        f"█ — занято, · — свободно, число справа — бронирований за день"
+    ]
+    for room_id in room_ids:
+        room_name = ROOM_NAMES.get(room_id, f"Зал {room_id}")
+        lines = [scale_line]
+        for date in dates:
+            label = f"{RUSSIAN_WEEKDAY_NAMES[date.weekday()]} {date:%d.%m} "
+            bookings = bookings_by_date[date]
+            if bookings is None:
+                lines.append(label + "нет данных")
+                continue
+            room_bookings = [b for b in bookings if b.room_id == room_id and not b.is_cancelled]
+            occupied = _occupied_hours(room_bookings)
+            cells = "".join("█" if hour in occupied else "·" for hour in hours)
+            lines.append(f"{label}{cells} {len(room_bookings) or ''}".rstrip())
+        grid = html.escape("\n".join(lines))
+        parts.append(f"🚪 {html.escape(room_name)}\n<pre>{grid}</pre>")
+
+    return parts
+
+
+async def show_week(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, start_date: datetime.date,
+                    selected_room: str, user_id: int):
+    """Показывает занятость залов на неделю одним сообщением"""
+    today = datetime.date.today()
+    is_admin = permissions.is_admin(user_id)
+    if not is_admin and start_date < today:
+        start_date = today
+
+    dates = [start_date + datetime.timedelta(days=offset) for offset in range(WEEK_VIEW_DAYS)]
+    await query.edit_message_text(f"⏳ Собираю расписание с {start_date:%d.%m} по {dates[-1]:%d.%m}...")
+
+    results = await fetch_bookings_for_dates([date.strftime('%Y%m%d') for date in dates], API_BASE_URL)
+    bookings_by_date = {date: results[date.strftime('%Y%m%d')] for date in dates}
+
+    if all(bookings is None for bookings in bookings_by_date.values()):
+        await query.edit_message_text("❌ Не удалось получить данные с сервера. Попробуйте позже.")
+        return
+
+    reply_markup = generate_week_navigation(
+        start_date,
+        WEEK_VIEW_DAYS,
+        selected_room,
+        can_go_back=is_admin or start_date > today
+    )
+    # Обычно сетка занимает одно сообщение; при большом числе залов
+    # разбиваем по залам, чтобы не разрывать HTML-разметку
+    messages = pack_messages(build_week_grid(start_date, bookings_by_date, selected_room))
+    await query.edit_message_text(
+        messages[0],
+        parse_mode="HTML",
+        reply_markup=reply_markup if len(messages) == 1 else None
+    )
+    for i, text in enumerate(messages[1:], 2):
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=text,
+            parse_mode="HTML",
+            reply_markup=reply_markup if i == len(messages) else None,
+            rate_limit_args={'priority': BULK}
+        )
+
+
+def _text_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def pack_messages(blocks: list, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list:
+    """
+    Упаковывает блоки текста в минимальное число сообщений длиной не более limit.
+    Разрыв делается только между блоками; слишком длинный блок обрезается.
+    """
+    separator = "\n\n"
+    messages = []
+    current = ""
+    current_length = 0
+
+    for block in blocks:
+        block_length = _text_length(block)
+        if block_length > limit:
+            block = block[:limit - 1]
+            while _text_length(block) > limit - 1:
+                block = block[:-1]
+            block += "…"
+            block_length = _text_length(block)
+
+        if not current:
+            current, current_length = block, block_length
+        elif current_length + len(separator) + block_length <= limit:
+            current += separator + block
+            current_length += len(separator) + block_length
+        else:
+            messages.append(current)
+            current, current_length = block, block_length
+
+    if current:
+        messages.append(current)
+    return messages
+
+
 async def send_bookings(
         context: ContextTypes.DEFAULT_TYPE,
         chat_id: int,
@@ -348,13 +646,7 @@ async def send_bookings(
     """Отправляет информацию о бронированиях с учетом прав доступа"""
     try:
         if selected_room and selected_room != "all":
-            bookings = [b for b in bookings if str(b.get('room_id')) == selected_room]
-
-        is_global_admin = user_id in ADMIN_USER_IDS
-        is_room_admin = any(
-            user_id in ROOM_ADMINS.get(b.get('room_id'), [])
-            for b in bookings
-        )
+            bookings = [b for b in bookings if str(b.room_id) == selected_room]
 
         if not bookings:
             if not selected_room or selected_room == "all":
@@ -369,77 +661,17 @@ async def send_bookings(
             )
             return
 
-        bookings_by_room = {}
-        for booking in bookings:
-            room_id = booking.get('room_id')
-            if room_id not in bookings_by_room:
-                bookings_by_room[room_id] = []
-            bookings_by_room[room_id].append(booking)
-
-        total_count = len(bookings)
-        room_count = len(bookings_by_room)
-
-        if selected_room and selected_room != "all":
-            room_name = ROOM_NAMES.get(int(selected_room), f"зал {selected_room}")
-            header = f"📋 Найдено {total_count} бронирований в {room_name}:"
-        else:
-            header = f"📋 Найдено {total_count} бронирований в {room_count} залах:"
+        messages = build_booking_messages(bookings, user_id, selected_room)
+        if SCHEDULE_BATCH_MESSAGES:
+            messages = pack_messages(messages)
 
-        await context.bot.send_message(chat_id=chat_id, text=header)
-
-        for room_id, room_bookings in sorted(bookings_by_room.items()):
-            room_name = ROOM_NAMES.get(room_id, f"Зал {room_id}")
-            is_current_room_admin = user_id in ROOM_ADMINS.get(room_id, [])
-
-            room_header = f"\n🚪 {room_name} ({len(room_bookings)} бронир.)"
-            if is_global_admin or is_current_room_admin:
-                room_header += " 👑"
-
-            await context.bot.send_message(chat_id=chat_id, text=room_header)
-
-            sorted_room_bookings = sorted(room_bookings, key=get_start_time)
-
-            for i, booking in enumerate(sorted_room_bookings, 1):
-                try:
-                    status = str(booking.get('status', '')).lower()
-                    is_cancelled = 'cancel' in status
-                    show_details = is_global_admin or is_current_room_admin
-
-                    message_parts = []
-
-                    if is_cancelled:
-                        message_parts.append("🟨🟨🟨 [ОТМЕНЕНО] 🟨🟨🟨")
-
-                    message_parts.append(f"#{i}: {booking.get('name', 'Без имени')}")
-
-                    if show_details:
-                        message_parts.append(f"📞: {booking.get('phone', 'Не указан')}")
-
-                    times = extract_times(booking.get('times', ''))
-                    if times:
-                        message_parts.append(f"🕒: {times}")
-
-                    message_parts.append(f"Статус: {status.capitalize()}")
-
-                    if show_details and booking.get('comment'):
-                        message_parts.append(f"💬: {booking['comment']}")
-
-                    if is_cancelled:
-                        message_parts.append("🟨🟨🟨 ОТМЕНЕНО 🟨🟨🟨")
-
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text="\n".join(message_parts)
-                    )
-
-                    await asyncio.sleep(0.3)
-
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке бронирования: {e}")
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"⚠️ Ошибка при отображении бронирования #{i}"
-                    )
+        # Темп отправки задает ограничитель запросов приложения (rate_limiter)
+        for text in messages:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                rate_limit_args={'priority': BULK}
+            )
 
     except Exception as e:
         logger.error(f"Критическая ошибка в send_bookings: {e}", exc_info=True)
@@ -474,6 +706,8 @@ async def handle_booking_room(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_booking_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает выбор даты для бронирования"""
     query = update.callback_query
+    # До первого await: дорисовка сводки не должна затереть сообщение со слотами
+    _invalidate_calendar(context, query.from_user.id)
     await query.answer()
 
     parts = query.data.split("_")
@@ -491,7 +725,7 @@ async def handle_booking_date(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
     # Получаем доступные слоты
-    slots = fetch_available_slots(room_id, booking_date)
+    slots = await fetch_available_slots_cached(room_id, booking_date)
 
     if not slots:
         await query.edit_message_text(
@@ -511,8 +745,8 @@ async def handle_booking_date(update: Update, context: ContextTypes.DEFAULT_TYPE
     return BOOKING_SLOTS
 
 
-async def show_booking_slots(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает доступные слоты для бронирования"""
+async def show_booking_slots(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, notice: str = None):
+    """Показывает доступные слоты для бронирования (notice — пояснение над списком)"""
     room_name = context.user_data['booking_room_name']
     booking_date = context.user_data['booking_date']
     slots = context.user_data['booking_slots']
@@ -527,6 +761,8 @@ async def show_booking_slots(query: CallbackQuery, context: ContextTypes.DEFAULT
         f"📅 Дата: {day}.{month}.{year}\n\n"
         f"Доступные слоты:"
     )
+    if notice:
+        text = f"{notice}\n\n{text}"
 
     # Создаем клавиатуру с кнопками слотов
     keyboard = []
@@ -591,6 +827,10 @@ async def handle_slots_confirm(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return BOOKING_SLOTS
 
+    # Слоты выбраны заново после конфликта при отправке: остальные данные заявки уже есть
+    if context.user_data.pop('booking_resume_summary', False):
+        return await show_confirmation_summary(query, context)
+
     # Проверяем, есть ли сохраненные данные пользователя
     if 'user_name' in context.user_data and 'user_phone' in context.user_data:
         # Используем сохраненные данные
@@ -724,6 +964,15 @@ async def show_confirmation_summary(update: Update, context: ContextTypes.DEFAUL
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
+    # Пока пользователь читает сводку, загружаем форму и CSRF-токен в фоне
+    if BOOKING_FORM_PREWARM and selected_slots:
+        form_prewarmer.start(
+            update.from_user.id if isinstance(update, CallbackQuery) else update.effective_user.id,
+            context.user_data.get('booking_room_id'),
+            booking_date,
+            selected_slots
+        )
+
     # The update can be a MessageUpdate or a CallbackQueryUpdate from skipping comment
     if isinstance(update, CallbackQuery):
         await update.edit_message_text(summary_text, parse_mode="Markdown", reply_markup=reply_markup)
@@ -745,7 +994,7 @@ def clear_booking_data(context: ContextTypes.DEFAULT_TYPE):
     keys_to_clear = [
         'booking_room_id', 'booking_room_name', 'booking_date',
         'booking_slots', 'selected_slots', 'booking_name',
-        'booking_phone', 'booking_comment', 'selected_room'
+        'booking_phone', 'booking_comment', 'selected_room', 'booking_resume_summary'
     ]
     for key in keys_to_clear:
         context.user_data.pop(key, None)
@@ -761,6 +1010,17 @@ async def finalize_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif update.message:
         await update.message.reply_text(text=submitting_text)
 
+    # Перепроверяем слоты перед отправкой: за время ввода данных их могли занять.
+    # Конфликт возвращает пользователя к выбору слотов, поэтому проверка идет и перед очередью
+    room_id = context.user_data.get('booking_room_id')
+    booking_date = context.user_data.get('booking_date')
+    selected_slots = context.user_data.get('selected_slots', [])
+    queued = SUBMISSION_QUEUE_ENABLED and submission_queue.running
+    current_slots, taken = await recheck_selected_slots(room_id, booking_date, selected_slots)
+    if taken:
+        form_prewarmer.discard(update.effective_user.id)
+        return await return_to_slot_selection(update, context, current_slots, taken)
+
     # Prepare comment
     user_comment = context.user_data.get('booking_comment', '')
     if user_comment and user_comment != "Пропущено":
@@ -768,17 +1028,43 @@ async def finalize_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         final_comment = "(Отправлено из тг бота)"
 
+    # Форма, загружаемая с показа сводки; очередь дождется ее сама
+    prepared_task = form_prewarmer.detach(update.effective_user.id, room_id, booking_date, selected_slots)
+
+    booking = {
+        'room_id': room_id,
+        'room_name': context.user_data.get('booking_room_name'),
+        'date_str': booking_date,
+        'selected_slots': selected_slots,
+        'all_slots': context.user_data.get('booking_slots', []),
+        'user_name': context.user_data.get('booking_name', 'Не указано'),
+        'phone_number': context.user_data.get('booking_phone', 'Не указан'),
+        'comment': final_comment,
+    }
+
+    # Заявка уходит в очередь, результат пользователь получит отдельным сообщением
+    if queued:
+        try:
+            created, status, result = await submission_queue.enqueue(
+                update.effective_user.id, chat_id, booking, prepared=prepared_task
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось поставить заявку в очередь, отправляю сразу: {e}")
+        else:
+            if created:
+                text = "📨 Заявка принята! Отправляю её на сайт, результат пришлю отдельным сообщением."
+            elif result is None:
+                text = "⏳ Эта заявка уже принята. Результат придет отдельным сообщением."
+            else:
+                success, message = result
+                text = f"ℹ️ Эта заявка уже отправлена.\n\n{'✅' if success else '❌'} {message}"
+            await context.bot.send_message(chat_id=chat_id, text=text)
+            clear_booking_data(context)
+            return ConversationHandler.END
+
     # Submit the booking
-    success, message = submit_booking(
-        room_id=context.user_data.get('booking_room_id'),
-        room_name=context.user_data.get('booking_room_name'),
-        date_str=context.user_data.get('booking_date'),
-        selected_slots=context.user_data.get('selected_slots', []),
-        all_slots=context.user_data.get('booking_slots', []),
-        user_name=context.user_data.get('booking_name', 'Не указано'),
-        phone_number=context.user_data.get('booking_phone', 'Не указан'),
-        comment=final_comment
-    )
+    prepared = await form_prewarmer.resolve(prepared_task)
+    success, message = await submit_booking(**booking, prepared=prepared)
 
     # Send the final status as a new message
     final_message = f"✅ {message}" if success else f"❌ {message}"
@@ -793,6 +1079,38 @@ async def finalize_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     clear_booking_data(context)
     return ConversationHandler.END
 
+async def return_to_slot_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, current_slots: list, taken: list):
+    """
+    Слоты заняли, пока пользователь заполнял заявку: показываем обновленный список слотов.
+    Имя, телефон и комментарий сохраняются, после выбора слотов снова показывается сводка.
+    """
+    query = update.callback_query
+    room_id = context.user_data.get('booking_room_id')
+    labels = dict(context.user_data.get('booking_slots', []))
+    taken_text = ", ".join(labels.get(slot, slot) for slot in taken)
+    context.user_data['booking_resume_summary'] = True
+
+    if not current_slots:
+        await query.edit_message_text(
+            f"❌ Пока вы заполняли заявку, заняли слоты: {taken_text}. Свободных слотов на эту дату больше нет.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("Выбрать другую дату", callback_data=f"book_retry_date_{room_id}")]
+            ])
+        )
+        return BOOKING_DATE
+
+    context.user_data['booking_slots'] = current_slots
+    context.user_data['selected_slots'] = [
+        slot for slot in context.user_data.get('selected_slots', []) if slot not in taken
+    ]
+    await show_booking_slots(
+        query,
+        context,
+        notice=f"⚠️ Пока вы заполняли заявку, заняли слоты: {taken_text}. "
+               f"Выберите слоты заново — остальные данные заявки сохранены."
+    )
+    return BOOKING_SLOTS
+
 async def handle_get_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Saves the comment from text and shows the confirmation summary."""
     context.user_data['booking_comment'] = update.message.text
@@ -830,6 +1148,8 @@ async def handle_retry_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel_booking_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /cancel"""
+    _invalidate_calendar(context, update.effective_user.id)
+    form_prewarmer.discard(update.effective_user.id)
     clear_booking_data(context)
     await update.message.reply_text(
         "❌ Бронирование отменено",
@@ -844,8 +1164,10 @@ async def cancel_booking_command(update: Update, context: ContextTypes.DEFAULT_T
 async def cancel_booking_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик отмены бронирования через callback"""
     query = update.callback_query
+    _invalidate_calendar(context, query.from_user.id)
     await query.answer()
 
+    form_prewarmer.discard(query.from_user.id)
     clear_booking_data(context)
 
     await query.edit_message_text("❌ Бронирование отменено")
@@ -853,6 +1175,108 @@ async def cancel_booking_callback(update: Update, context: ContextTypes.DEFAULT_
     return ConversationHandler.END
 
 
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /cache_stats (только для администраторов)"""
+    if not permissions.is_global_admin(update.effective_user.id):
+        return
+
+    lines = ["📊 Статистика кэшей:"]
+    for cache in (schedule_cache, slots_cache, availability_cache):
+        stats = cache.stats()
+        lines.append(
+            f"{stats['name']}: записей {stats['size']}, попаданий {stats['hits']}, "
+            f"устаревших {stats['stale_hits']}, промахов {stats['misses']}, "
+            f"обновлений {stats['refreshes']}, hit ratio {stats['hit_ratio']}"
+        )
+
+    persistence = context.application.persistence
+    if persistence is not None and hasattr(persistence, 'stats'):
+        stats = persistence.stats()
+        lines.append(
+            f"persistence: записей {stats['writes']}, пропущено без изменений {stats['skipped_writes']}, "
+            f"в очереди {stats['pending_writes']}"
+        )
+
+    stats = form_prewarmer.stats()
+    lines.append(
+        f"предзагрузка формы: использовано {stats['used']}, без нее {stats['missed']}, "
+        f"подготовлено сейчас {stats['pending']}"
+    )
+
+    if submission_queue.running:
+        stats = submission_queue.stats()
+        lines.append(
+            f"заявки: в очереди {stats['pending']}, отправляются {stats['sending']}, принято {stats['accepted']}, "
+            f"повторных {stats['duplicates']}, успешно {stats['succeeded']}, с ошибкой {stats['failed']}, "
+            f"повторов отправки {stats['retries']}"
+        )
+
+    if hasattr(context.bot.rate_limiter, 'stats'):
+        stats = context.bot.rate_limiter.stats()
+        lines.append(
+            f"исходящие: отправлено {stats['sent']}, повторов после 429 {stats['retries']}, "
+            f"ждут {stats['waiting_interactive']} интерактивных / {stats['waiting_bulk']} массовых"
+        )
+
+    if hasattr(context.application, 'processing_snapshot'):
+        stats = context.application.processing_snapshot()
+        lines.append(
+            f"обновления: в очереди {stats['queue_size']}, ждут пользователя {stats['waiting_for_user']}, "
+            f"ждут обработчика {stats['waiting_for_worker']}, в работе {stats['in_progress']}, "
+            f"обработано {stats['processed']}, ожидание пользователя ср. {stats['avg_user_wait']} с / "
+            f"макс. {stats['max_user_wait']} с"
+        )
+    # Самые медленные обработчики по оценке p99 из гистограмм метрик
+    handler_lines = []
+    for labels in handler_latency.label_values():
+        p99 = handler_latency.quantile(0.99, **labels)
+        handler_lines.append((p99, f"{labels['handler']}: p50 ≤ {handler_latency.quantile(0.5, **labels)} с, "
+                                   f"p99 ≤ {p99} с, вызовов {handler_latency.count(**labels)}"))
+    if handler_lines:
+        lines.append("обработчики (самые медленные):")
+        lines.extend(text for _, text in sorted(handler_lines, reverse=True)[:5])
+    await update.message.reply_text("\n".join(lines))
+
+
+async def reload_admins_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reload_admins: перечитывает таблицу admins без перезапуска"""
+    if not permissions.is_global_admin(update.effective_user.id):
+        return
+
+    try:
+        await asyncio.to_thread(permissions.reload_from_db, PERSISTENCE_PATH)
+        await update.message.reply_text("✅ Список администраторов обновлен")
+    except Exception as e:
+        logger.error(f"Ошибка при перезагрузке администраторов: {e}")
+        await update.message.reply_text("⚠️ Не удалось обновить список администраторов")
+
+
+async def profiling_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /profiling [on [доля] | off]: выборочное профилирование
+    медленных обновлений (только для глобальных администраторов)
+    """
+    if not permissions.is_global_admin(update.effective_user.id):
+        return
+
+    args = context.args or []
+    if args and args[0].lower() in ("on", "off"):
+        profiler.enabled = args[0].lower() == "on"
+        if profiler.enabled and len(args) > 1:
+            try:
+                profiler.sample_rate = min(max(float(args[1].replace(',', '.')), 0.0), 1.0)
+            except ValueError:
+                await update.message.reply_text("⚠️ Доля выборки должна быть числом от 0 до 1")
+                return
+
+    state = "включено" if profiler.enabled else "выключено"
+    await update.message.reply_text(
+        f"🔬 Профилирование медленных обновлений {state}\n"
+        f"доля выборки {profiler.sample_rate}, сохранено профилей {profiler.saved} из {profiler.max_files}\n"
+        f"каталог: {profiler.directory}"
+    )
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and the update that caused it."""
     # Log the error with traceback
@@ -875,6 +1299,9 @@ def setup_handlers(app):
 
     # Обработчик команды /start
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("cache_stats", cache_stats_command))
+    app.add_handler(CommandHandler("reload_admins", reload_admins_command))
+    app.add_handler(CommandHandler("profiling", profiling_command))
 
     # Сначала регистрируем ConversationHandler для бронирования
     conv_handler = ConversationHandler(
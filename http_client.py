@@ -0,0 +1,93 @@
+import httpx
+import logging
+import time
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from config import HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE
+from metrics import upstream_latency
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'TelegramBookingBot/1.0'
+
+_client = None
+
+
+def _timeout():
+    return httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE
+    )
+
+
+class _MeasuredTransport(httpx.AsyncBaseTransport):
+    """Транспорт, записывающий время до заголовков ответа и код статуса в метрики"""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            with span(f"{request.method} {request.url.host}{request.url.path}"):
+                response = await self._transport.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            upstream_latency.observe(
+                time.perf_counter() - started,
+                host=request.url.host,
+                method=request.method,
+                status=status
+            )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _transport():
+    return _MeasuredTransport(httpx.AsyncHTTPTransport(limits=_limits()))
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Общий асинхронный клиент с пулом соединений и keep-alive.
+    Куки не сохраняются: клиент разделяется между всеми пользователями.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=_timeout(),
+            transport=_transport(),
+            headers={'User-Agent': USER_AGENT},
+            follow_redirects=True,
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+    return _client
+
+
+def new_session() -> httpx.AsyncClient:
+    """
+    Отдельный клиент со своими куками (аналог requests.Session)
+    для многошаговых сценариев, например отправки формы с CSRF-токеном.
+    """
+    return httpx.AsyncClient(
+        timeout=_timeout(),
+        transport=_transport(),
+        headers={'User-Agent': USER_AGENT},
+        follow_redirects=True,
+    )
+
+
+async def close_client(application=None) -> None:
+    """Закрывает общий клиент (используется как post_shutdown приложения)"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logger.info("HTTP-клиент закрыт")
+    _client = None
@@ -1,6 +1,9 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from functools import lru_cache
 import calendar
 import datetime
+from config import CALENDAR_CACHE_SIZE
+from permissions import permissions
 
 
 def generate_room_selection(room_names, prefix="select_room_"):
@@ -27,20 +30,59 @@ RUSSIAN_MONTH_NAMES = [
     "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
 ]
 
+RUSSIAN_WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+# Число свободных слотов рядом с днем пишем надстрочными цифрами, занятый день — ✖
+_SUPERSCRIPT_DIGITS = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
+FULL_DAY_MARK = "✖"
+
+# Дата, для которой построены закэшированные календари
+_calendar_cache_date = None
+
+
 def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
-                      room_names=None, admin_ids=None, room_admins=None, purpose="view"):
-    """Генерирует интерактивный календарь с учетом цели (просмотр/бронирование)"""
-    now = datetime.datetime.now()
-    year = year or now.year
-    month = month or now.month
+                      room_names=None, purpose="view", availability=None):
+    """
+    Генерирует интерактивный календарь с учетом цели (просмотр/бронирование).
+    availability — {день: число свободных слотов или None} для календаря бронирования.
+    """
+    global _calendar_cache_date
+    today = datetime.date.today()
+    year = year or today.year
+    month = month or today.month
 
     # Проверка прав администратора
-    is_admin = user_id in admin_ids or any(user_id in room_admins.get(rid, []) for rid in room_admins)
+    is_admin = permissions.is_admin(user_id)
+
+    # После полуночи старые календари больше не нужны
+    if today != _calendar_cache_date:
+        _build_calendar.cache_clear()
+        _calendar_cache_date = today
+
+    # Для lru_cache сводка нужна в хэшируемом виде
+    availability_key = tuple(sorted(availability.items())) if availability else None
+    return _build_calendar(year, month, selected_room, purpose, is_admin, today, availability_key)
+
+
+def _day_label(day, free_slots):
+    if free_slots is None:
+        return str(day)
+    if free_slots == 0:
+        return f"{day}{FULL_DAY_MARK}"
+    return f"{day}{str(free_slots).translate(_SUPERSCRIPT_DIGITS)}"
+
 
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _build_calendar(year, month, selected_room, purpose, is_admin, today, availability=None):
+    """
+    Строит разметку календаря. Результат зависит только от аргументов,
+    а InlineKeyboardMarkup неизменяем, поэтому его можно переиспользовать.
+    """
     month_name = RUSSIAN_MONTH_NAMES[month]
+    free_slots_by_day = dict(availability) if availability else {}
     keyboard = [
         [InlineKeyboardButton(f"{month_name} {year}", callback_data="ignore")],
-        [InlineKeyboardButton(day, callback_data="ignore") for day in ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]]
+        [InlineKeyboardButton(day, callback_data="ignore") for day in RUSSIAN_WEEKDAY_NAMES]
     ]
 
     for week in calendar.monthcalendar(year, month):
@@ -50,11 +92,11 @@ def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
                 week_buttons.append(InlineKeyboardButton(" ", callback_data="ignore"))
             else:
                 # Для бронирования разрешаем только будущие даты
-                selected_date = datetime.datetime(year, month, day)
-                if purpose == "booking" and selected_date.date() < now.date():
+                is_past = datetime.date(year, month, day) < today
+                if purpose == "booking" and is_past:
                     week_buttons.append(InlineKeyboardButton(" ", callback_data="ignore"))
                     continue
-                elif purpose == "view" and not is_admin and selected_date.date() < now.date():
+                elif purpose == "view" and not is_admin and is_past:
                     week_buttons.append(InlineKeyboardButton(" ", callback_data="ignore"))
                     continue
 
@@ -64,7 +106,7 @@ def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
                 if purpose == "booking":
                     callback_data += "_book"
                 week_buttons.append(InlineKeyboardButton(
-                    str(day),
+                    _day_label(day, free_slots_by_day.get(day)),
                     callback_data=callback_data
                 ))
         keyboard.append(week_buttons)
@@ -78,7 +120,7 @@ def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
     nav_buttons = []
 
     # Для неадминистраторов скрываем кнопку "назад" если это текущий месяц (для просмотра)
-    if purpose == "view" and (is_admin or (year > now.year) or (year == now.year and month > now.month)):
+    if purpose == "view" and (is_admin or (year > today.year) or (year == today.year and month > today.month)):
         if selected_room:
             callback_data = f"prev_{prev_year}_{prev_month}_{selected_room}"
             if purpose == "booking":
@@ -89,7 +131,7 @@ def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
             if purpose == "booking":
                 callback_data += "_book"
             nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=callback_data))
-    elif purpose == "booking" and (year > now.year or (year == now.year and month >= now.month)):
+    elif purpose == "booking" and (year > today.year or (year == today.year and month >= today.month)):
         # Для бронирования всегда показываем навигацию, если месяц не в прошлом
         if selected_room:
             callback_data = f"prev_{prev_year}_{prev_month}_{selected_room}_book"
@@ -112,4 +154,44 @@ def generate_calendar(year=None, month=None, selected_room=None, user_id=None,
     if nav_buttons:
         keyboard.append(nav_buttons)
 
-    return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+    # Недельный вид: с сегодняшнего дня для текущего месяца, иначе с 1-го числа
+    if purpose == "view":
+        week_start = today if (year, month) == (today.year, today.month) else datetime.date(year, month, 1)
+        if is_admin or week_start >= today:
+            keyboard.append([InlineKeyboardButton(
+                "📆 Сетка на неделю",
+                callback_data=week_callback_data(week_start, selected_room)
+            )])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def week_callback_data(start_date, selected_room=None):
+    """callback_data недельного вида: week_ГГГГММДД[_зал]"""
+    callback_data = f"week_{start_date:%Y%m%d}"
+    if selected_room and selected_room != "all":
+        callback_data += f"_{selected_room}"
+    return callback_data
+
+
+def generate_week_navigation(start_date, days, selected_room=None, can_go_back=True):
+    """Клавиатура недельного вида: соседние недели и возврат к календарю"""
+    step = datetime.timedelta(days=days)
+    nav_buttons = []
+    if can_go_back:
+        nav_buttons.append(InlineKeyboardButton(
+            "⬅️ Неделя",
+            callback_data=week_callback_data(start_date - step, selected_room)
+        ))
+    nav_buttons.append(InlineKeyboardButton(
+        "Неделя ➡️",
+        callback_data=week_callback_data(start_date + step, selected_room)
+    ))
+
+    calendar_data = f"next_{start_date.year}_{start_date.month}"
+    if selected_room:
+        calendar_data += f"_{selected_room}"
+    return InlineKeyboardMarkup([
+        nav_buttons,
+        [InlineKeyboardButton("📅 Календарь", callback_data=calendar_data)]
+    ])
\ No newline at end of file
@@ -1,8 +1,26 @@
 from telegram.ext import Application
+import asyncio
 import logging
 from handlers import setup_handlers
-from config import TOKEN
+from config import (
+    TOKEN, PREFETCH_ENABLED, PERSISTENCE_PATH, PERSISTENCE_WRITE_INTERVAL, PERSISTENCE_MAX_PENDING_WRITES,
+    WEBHOOK_ENABLED, DROP_PENDING_UPDATES, UPDATE_QUEUE_SIZE, UPDATE_WORKERS, METRICS_ENABLED,
+    SUBMISSION_QUEUE_ENABLED
+)
 from sqlite_persistence import SQLitePersistence
+from http_client import close_client
+from prefetch import schedule_prefetch
+from permissions import permissions
+from webhook import run_webhook
+from update_processing import ConcurrentApplication
+from rate_limiter import PriorityRateLimiter
+from api_utils import schedule_cache
+from booking_utils import slots_cache, availability_cache, form_prewarmer
+from submission_queue import submission_queue
+from metrics import (
+    metrics_server, instrument_handlers, register_cache_metrics, register_processing_metrics,
+    register_submission_metrics
+)
 
 # Настройка логов
 logging.basicConfig(
@@ -14,18 +32,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+async def post_init(app):
+    if METRICS_ENABLED:
+        await metrics_server.start()
+    if SUBMISSION_QUEUE_ENABLED:
+        await submission_queue.start(app)
+
+
+async def post_stop(app):
+    # До закрытия бота: начатые отправки успевают сообщить результат
+    await submission_queue.stop()
+
+
+async def post_shutdown(app):
+    await metrics_server.stop()
+    await form_prewarmer.close_all()
+    await close_client(app)
+
+
 def main():
     """Запуск бота"""
     try:
         # Создаем объект persistence
-        persistence = SQLitePersistence(filepath="data/bot.db")
+        persistence = SQLitePersistence(
+            filepath=PERSISTENCE_PATH,
+            write_interval=PERSISTENCE_WRITE_INTERVAL,
+            max_pending_writes=PERSISTENCE_MAX_PENDING_WRITES
+        )
+
+        # Права администраторов: config + таблица admins в базе бота
+        permissions.reload_from_db(PERSISTENCE_PATH)
 
         # Создаем приложение с persistence
-        app = Application.builder().token(TOKEN).persistence(persistence).build()
+        app = (
+            Application.builder()
+            .token(TOKEN)
+            .persistence(persistence)
+            .rate_limiter(PriorityRateLimiter())
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            .application_class(ConcurrentApplication)
+            # Число задач в работе ограничено размером очереди, число обработчиков — UPDATE_WORKERS
+            .concurrent_updates(UPDATE_QUEUE_SIZE if UPDATE_WORKERS else False)
+            .post_init(post_init)
+            .post_stop(post_stop)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
         setup_handlers(app)
+        instrument_handlers(app)
+        register_cache_metrics(schedule_cache, slots_cache, availability_cache)
+        register_processing_metrics(app)
+        register_submission_metrics(submission_queue)
+        if PREFETCH_ENABLED:
+            schedule_prefetch(app)
         logger.info("Бот запущен и ожидает сообщений...")
-        app.run_polling(drop_pending_updates=True)
+        if WEBHOOK_ENABLED:
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
     except Exception as e:
         logger.error(f"Ошибка при запуске: {e}")
@@ -0,0 +1,321 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Счетчики и гистограммы обновляются из кода (обработчики, HTTP-клиент,
+persistence, ограничитель запросов), значения кэшей и очереди обновлений
+снимаются коллекторами в момент запроса GET /metrics.
+"""
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from telegram.ext import ConversationHandler
+from config import METRICS_LISTEN, METRICS_PORT
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм времени, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами и метками"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # метки -> [счетчики по корзинам (+Inf последней), сумма, количество]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def label_values(self):
+        """Наборы меток с наблюдениями: [{метка: значение}]"""
+        return [dict(zip(self.labelnames, key)) for key in sorted(self._series)]
+
+    def count(self, **labels):
+        series = self._series.get(tuple(str(labels[name]) for name in self.labelnames))
+        return series[2] if series else 0
+
+    def quantile(self, q, **labels):
+        """Оценка квантиля по корзинам (верхняя граница корзины), None без наблюдений"""
+        series = self._series.get(tuple(str(labels[name]) for name in self.labelnames))
+        if series is None or not series[2]:
+            return None
+        rank = q * series[2]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), series[0]):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """
+        collector() возвращает список (имя, тип, описание, [(метки dict, значение)]),
+        значения снимаются при каждом запросе метрик.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.error(f"Ошибка коллектора метрик: {e}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    label_text = _format_labels(list(labels), list(labels.values()))
+                    lines.append(f"{name}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', "Время работы обработчиков обновлений", ['handler']
+)
+handler_errors = registry.counter(
+    'bot_handler_errors_total', "Исключения в обработчиках обновлений", ['handler']
+)
+upstream_latency = registry.histogram(
+    'bot_upstream_request_duration_seconds',
+    "Время до получения заголовков ответа внешних сервисов",
+    ['host', 'method', 'status']
+)
+persistence_write_latency = registry.histogram(
+    'bot_persistence_write_duration_seconds', "Время записи пачки строк в базу бота"
+)
+persistence_rows_written = registry.counter(
+    'bot_persistence_rows_written_total', "Строк записано в базу бота"
+)
+outbound_requests = registry.counter(
+    'bot_outbound_requests_total', "Запросы к Bot API", ['endpoint', 'priority']
+)
+outbound_retries = registry.counter(
+    'bot_outbound_retries_total', "Повторы запросов к Bot API после ответа 429", ['endpoint']
+)
+
+
+# --- Обработчики ---
+
+def timed(callback, name=None):
+    """Оборачивает callback обработчика замером времени, подсчетом ошибок и участком трассы"""
+    if getattr(callback, '_metrics_timed', False):
+        return callback
+    name = name or getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            with span(f"обработчик {name}"):
+                return await callback(update, context)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, handler=name)
+
+    wrapper._metrics_timed = True
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for nested_handler in nested:
+            _instrument_handler(nested_handler)
+    elif asyncio.iscoroutinefunction(handler.callback):
+        handler.callback = timed(handler.callback)
+
+
+def instrument_handlers(app):
+    """Добавляет замер времени ко всем зарегистрированным обработчикам (включая ConversationHandler)"""
+    for group_handlers in app.handlers.values():
+        for handler in group_handlers:
+            _instrument_handler(handler)
+
+
+# --- Коллекторы ---
+
+def register_cache_metrics(*caches):
+    """Метрики TTLCache: размер, попадания, промахи и доля попаданий"""
+    def collect():
+        stats = [cache.stats() for cache in caches]
+        return [
+            ('bot_cache_size', 'gauge', "Записей в кэше",
+             [({'cache': s['name']}, s['size']) for s in stats]),
+            ('bot_cache_hits_total', 'counter', "Попадания в свежие записи кэша",
+             [({'cache': s['name']}, s['hits']) for s in stats]),
+            ('bot_cache_stale_hits_total', 'counter', "Ответы устаревшими записями с фоновым обновлением",
+             [({'cache': s['name']}, s['stale_hits']) for s in stats]),
+            ('bot_cache_misses_total', 'counter', "Промахи кэша",
+             [({'cache': s['name']}, s['misses']) for s in stats]),
+            ('bot_cache_hit_ratio', 'gauge', "Доля попаданий (включая устаревшие записи)",
+             [({'cache': s['name']}, s['hit_ratio']) for s in stats]),
+        ]
+    registry.register_collector(collect)
+
+
+def register_processing_metrics(app):
+    """Очередь и параллельная обработка обновлений (ConcurrentApplication)"""
+    if not hasattr(app, 'processing_snapshot'):
+        return
+
+    def collect():
+        stats = app.processing_snapshot()
+        return [
+            ('bot_update_queue_size', 'gauge', "Обновлений в очереди", [({}, stats['queue_size'])]),
+            ('bot_updates_in_progress', 'gauge', "Обновлений в обработке", [({}, stats['in_progress'])]),
+            ('bot_updates_waiting_for_user', 'gauge', "Обновлений ждут предыдущих обновлений пользователя",
+             [({}, stats['waiting_for_user'])]),
+            ('bot_updates_processed_total', 'counter', "Обработано обновлений", [({}, stats['processed'])]),
+        ]
+    registry.register_collector(collect)
+
+
+def register_submission_metrics(queue):
+    """Очередь отправки заявок на сайт бронирования"""
+    def collect():
+        stats = queue.stats()
+        return [
+            ('bot_submissions_pending', 'gauge', "Заявок ждут отправки", [({}, stats['pending'])]),
+            ('bot_submissions_in_progress', 'gauge', "Заявок отправляется", [({}, stats['sending'])]),
+            ('bot_submissions_total', 'counter', "Заявок по результату",
+             [({'result': 'succeeded'}, stats['succeeded']), ({'result': 'failed'}, stats['failed'])]),
+            ('bot_submission_retries_total', 'counter', "Повторы отправки после временных ошибок",
+             [({}, stats['retries'])]),
+        ]
+    registry.register_collector(collect)
+
+
+# --- HTTP ---
+
+class MetricsServer:
+    """HTTP-сервер для GET /metrics (одно соединение — один запрос)"""
+
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT):
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logger.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            method, target = head.decode('latin-1').split(' ', 2)[:2]
+            if method == 'GET' and target.split('?', 1)[0] == '/metrics':
+                status, body = "200 OK", registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer()
@@ -0,0 +1,83 @@
+import logging
+import sqlite3
+from config import ADMIN_USER_IDS, ROOM_ADMINS
+
+logger = logging.getLogger(__name__)
+
+
+class PermissionIndex:
+    """
+    Индекс прав администраторов: все проверки — O(1) по множествам.
+    Строится из config и дополняется таблицей admins в базе бота.
+    """
+
+    def __init__(self, admin_ids=(), room_admins=None):
+        self._build(admin_ids, room_admins or {})
+
+    def _build(self, admin_ids, room_admins):
+        rooms_by_user = {}
+        for room_id, user_ids in room_admins.items():
+            for user_id in user_ids:
+                rooms_by_user.setdefault(user_id, set()).add(room_id)
+
+        # Индекс заменяется одним присваиванием: /reload_admins строит его в другом потоке,
+        # и проверки видят либо старый, либо новый индекс целиком
+        self._index = (
+            frozenset(admin_ids),
+            {user_id: frozenset(rooms) for user_id, rooms in rooms_by_user.items()}
+        )
+
+    def is_global_admin(self, user_id):
+        return user_id in self._index[0]
+
+    def administers_room(self, user_id, room_id):
+        """Администратор конкретного зала (без учета глобальных прав)"""
+        rooms = self._index[1].get(user_id)
+        return rooms is not None and room_id in rooms
+
+    def administers_any_room(self, user_id):
+        return user_id in self._index[1]
+
+    def is_admin(self, user_id):
+        """Глобальный администратор или администратор хотя бы одного зала"""
+        global_admins, rooms_by_user = self._index
+        return user_id in global_admins or user_id in rooms_by_user
+
+    def can_see_details(self, user_id, room_id):
+        """Видит телефоны и комментарии бронирований зала"""
+        global_admins, rooms_by_user = self._index
+        rooms = rooms_by_user.get(user_id)
+        return user_id in global_admins or (rooms is not None and room_id in rooms)
+
+    def reload_from_db(self, db_path):
+        """
+        Перестраивает индекс: администраторы из config плюс строки таблицы admins
+        (room_id IS NULL — глобальный администратор).
+        """
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS admins (
+                    user_id INTEGER NOT NULL,
+                    room_id INTEGER,
+                    UNIQUE (user_id, room_id)
+                )
+            ''')
+            conn.commit()
+            rows = conn.execute("SELECT user_id, room_id FROM admins").fetchall()
+        finally:
+            conn.close()
+
+        admin_ids = set(ADMIN_USER_IDS)
+        room_admins = {room_id: set(user_ids) for room_id, user_ids in ROOM_ADMINS.items()}
+        for user_id, room_id in rows:
+            if room_id is None:
+                admin_ids.add(user_id)
+            else:
+                room_admins.setdefault(room_id, set()).add(user_id)
+
+        self._build(admin_ids, room_admins)
+        logger.info(f"Права администраторов загружены: глобальных {len(admin_ids)}, строк в таблице admins {len(rows)}")
+
+
+permissions = PermissionIndex(ADMIN_USER_IDS, ROOM_ADMINS)
@@ -0,0 +1,69 @@
+import asyncio
+import datetime
+import logging
+import random
+from telegram.ext import ContextTypes
+from api_utils import fetch_bookings_cached, schedule_cache
+from booking_utils import fetch_available_slots_cached, slots_cache
+from config import (
+    API_BASE_URL, ROOM_NAMES, PREFETCH_DAYS, PREFETCH_INTERVAL,
+    PREFETCH_CONCURRENCY, PREFETCH_JITTER, PREFETCH_REQUESTED_ONLY, PREFETCH_REQUESTED_WINDOW
+)
+
+logger = logging.getLogger(__name__)
+
+
+def upcoming_dates(days=PREFETCH_DAYS):
+    """Сегодняшняя и следующие даты для предзагрузки"""
+    today = datetime.date.today()
+    return [today + datetime.timedelta(days=offset) for offset in range(days)]
+
+
+async def _limited(semaphore, func, *args, **kwargs):
+    """Выполняет запрос под семафором со случайной задержкой (jitter)"""
+    async with semaphore:
+        await asyncio.sleep(random.uniform(0, PREFETCH_JITTER))
+        return await func(*args, **kwargs)
+
+
+async def prefetch_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Задача JobQueue: прогревает кэши расписания и слотов.
+    С PREFETCH_REQUESTED_ONLY — только для недавно запрошенных дат и залов.
+    """
+    if PREFETCH_REQUESTED_ONLY:
+        requested_schedule = schedule_cache.requested_within(PREFETCH_REQUESTED_WINDOW)
+        requested_slots = slots_cache.requested_within(PREFETCH_REQUESTED_WINDOW)
+    semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    tasks = []
+
+    for date in upcoming_dates():
+        schedule_date = date.strftime('%Y%m%d')
+        if not PREFETCH_REQUESTED_ONLY or (API_BASE_URL, schedule_date) in requested_schedule:
+            tasks.append(_limited(semaphore, fetch_bookings_cached, schedule_date, API_BASE_URL, fresh=True))
+
+        booking_date = date.strftime('%Y-%m-%d')
+        for room_id in ROOM_NAMES:
+            if not PREFETCH_REQUESTED_ONLY or (int(room_id), booking_date) in requested_slots:
+                tasks.append(_limited(semaphore, fetch_available_slots_cached, room_id, booking_date, fresh=True))
+
+    if not tasks:
+        return
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = sum(1 for result in results if result is None or isinstance(result, Exception))
+    logger.info(f"Предзагрузка завершена: запросов {len(results)}, ошибок {failed}")
+
+
+def schedule_prefetch(app):
+    """Регистрирует периодическую предзагрузку в JobQueue приложения"""
+    if app.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]), предзагрузка отключена")
+        return
+
+    app.job_queue.run_repeating(
+        prefetch_job,
+        interval=PREFETCH_INTERVAL,
+        first=1,
+        name="prefetch"
+    )
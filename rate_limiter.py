@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from metrics import outbound_requests, outbound_retries
+from tracing import span
+from config import (
+    RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_PRIVATE_PER_SECOND, RATE_LIMIT_GROUP_PER_MINUTE,
+    RATE_LIMIT_CHAT_BURST, RATE_LIMIT_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: интерактивные ответы и правки сообщений
+# обслуживаются раньше массовой отправки (например, расписания)
+INTERACTIVE = 0
+BULK = 1
+
+# Запросы, которые не отправляют сообщений в чат и не ограничиваются
+_UNLIMITED_ENDPOINTS = {'answerCallbackQuery', 'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook'}
+
+
+class StaleRequest(Exception):
+    """Запрос не отправлен: пока он ждал очереди, его содержимое устарело (см. still_current)"""
+
+
+# Сколько корзин чатов хранить, прежде чем удалять простаивающие
+_MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не более capacity накоплено"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = [0, 0]  # ожидающих по приоритетам INTERACTIVE, BULK
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity and not any(self.waiting)
+
+    async def acquire(self, priority=INTERACTIVE):
+        self.waiting[priority] += 1
+        try:
+            while True:
+                self._refill()
+                # Массовые запросы пропускают вперед ожидающие интерактивные
+                if self.tokens >= 1 and (priority == INTERACTIVE or not self.waiting[INTERACTIVE]):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, 0.01))
+        finally:
+            self.waiting[priority] -= 1
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Ограничитель исходящих запросов Bot API для всего приложения.
+
+    Общий лимит бота и лимиты отдельных чатов (личные / группы) реализованы
+    корзинами токенов. Приоритет передается через rate_limit_args, например
+    ``bot.send_message(..., rate_limit_args={'priority': BULK})``.
+    ``rate_limit_args={'still_current': функция}`` проверяется после ожидания,
+    непосредственно перед отправкой; если она вернула False, поднимается StaleRequest.
+    При ответе 429 все запросы приостанавливаются на retry_after и повторяются.
+    """
+
+    def __init__(self, max_retries=RATE_LIMIT_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._global = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_PER_SECOND)
+        self._chats = {}
+        self._paused_until = 0.0
+        self.sent = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_IDLE_BUCKETS:
+                for idle_id in [key for key, value in self._chats.items() if value.is_idle()]:
+                    del self._chats[idle_id]
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            rate = RATE_LIMIT_PRIVATE_PER_SECOND if is_private else RATE_LIMIT_GROUP_PER_MINUTE / 60
+            bucket = self._chats[chat_id] = TokenBucket(rate, RATE_LIMIT_CHAT_BURST)
+        return bucket
+
+    async def _wait_for_pause(self):
+        delay = self._paused_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._paused_until - time.monotonic()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        with span(f"Bot API {endpoint}"):
+            return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+    async def _process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        priority = BULK if rate_limit_args.get('priority') == BULK else INTERACTIVE
+        still_current = rate_limit_args.get('still_current')
+        chat_id = data.get('chat_id')
+        limited = chat_id is not None and endpoint not in _UNLIMITED_ENDPOINTS
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_pause()
+            if limited:
+                if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+                    chat_id = int(chat_id)
+                await self._chat_bucket(chat_id).acquire(priority)
+                await self._global.acquire(priority)
+            if still_current is not None and not still_current():
+                raise StaleRequest(endpoint)
+
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                outbound_requests.inc(endpoint=endpoint, priority='bulk' if priority == BULK else 'interactive')
+                return result
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+                outbound_retries.inc(endpoint=endpoint)
+                logger.warning(f"Telegram ответил 429 на {endpoint}, пауза {e.retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retries': self.retries,
+            'chats': len(self._chats),
+            'waiting_interactive': self._global.waiting[INTERACTIVE],
+            'waiting_bulk': self._global.waiting[BULK],
+        }
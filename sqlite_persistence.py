@@ -1,125 +1,386 @@
+import asyncio
+import logging
+import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import json
 import pickle
-from telegram.ext import BasePersistence
+import state_codec
+import time
+from metrics import persistence_write_latency, persistence_rows_written
+from tracing import span
+from telegram.ext import BasePersistence, PersistenceInput
 from collections import defaultdict
 from typing import Dict, Any, Tuple, Optional, cast
 
+logger = logging.getLogger(__name__)
+
+# 1: original schema (JSON text rows, pickled conversation states)
+# 2: rows encoded by state_codec (format byte + JSON), integer conversation key columns
+SCHEMA_VERSION = 2
+
+
 class SQLitePersistence(BasePersistence):
     """
     A class for SQLite-based persistence for python-telegram-bot.
+
+    All database work runs off the event loop: writes go through a dedicated
+    writer thread with its own connection, reads use a separate read-only
+    connection on a reader thread.
+
+    With ``write_interval`` > 0 the persistence works in write-behind mode:
+    changed rows are buffered in memory and written in a single transaction
+    every ``write_interval`` seconds, on ``flush()``/``close()``, or as soon as
+    ``max_pending_writes`` rows are waiting.
+
+    Rows are stored in the versioned format of ``state_codec``;
+    databases created with the original JSON/pickle schema are migrated on start.
+
+    Rows whose content equals the last written (or loaded) version are not
+    serialized or written again; ``skipped_writes`` counts those calls.
     """
 
-    def __init__(self, filepath: str, store_user_data: bool = True, store_chat_data: bool = True, store_bot_data: bool = True):
-        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data, store_bot_data=store_bot_data)
+    def __init__(self, filepath: str, store_user_data: bool = True, store_chat_data: bool = True,
+                 store_bot_data: bool = True, update_interval: float = 60, write_interval: float = 0,
+                 max_pending_writes: int = 500):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=store_bot_data,
+                chat_data=store_chat_data,
+                user_data=store_user_data,
+                callback_data=False
+            ),
+            update_interval=update_interval
+        )
         self.filepath = filepath
+        self.write_interval = write_interval
+        self.max_pending_writes = max_pending_writes
+        # (table, key) -> (statement, params); the latest write for a row wins
+        self._pending: Dict[Tuple[str, Any], Tuple[str, tuple]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # (table, key) -> last persisted content, used to skip unchanged writes
+        self._snapshots: Dict[Tuple[str, Any], Any] = {}
+        self.writes = 0
+        self.skipped_writes = 0
+
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Each executor has exactly one thread, which is the only user of its connection
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-reader")
+        self.conn = self._writer.submit(self._open_write_connection).result()
+        self.read_conn = self._reader.submit(self._open_read_connection).result()
+
+    def _open_write_connection(self) -> sqlite3.Connection:
+        """Open the writer connection with WAL journaling and create the tables."""
         self.conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self._create_tables()
+        return self.conn
+
+    def _open_read_connection(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.filepath}?mode=ro", uri=True, check_same_thread=False)
+
+    async def _run_write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def _run_read(self, query: str, params: tuple = ()):
+        def fetch():
+            return self.read_conn.execute(query, params).fetchall()
+        with span("sqlite read"):
+            return await asyncio.get_running_loop().run_in_executor(self._reader, fetch)
+
+    def _execute_batch(self, writes) -> None:
+        """Runs on the writer thread: apply all writes in a single transaction."""
+        with self.conn:
+            for statement, params in writes:
+                self.conn.execute(statement, params)
+
+    async def _commit_batch(self, writes) -> None:
+        """Apply a batch of writes on the writer thread and record its duration."""
+        started = time.perf_counter()
+        with span(f"sqlite write {len(writes)} rows"):
+            await self._run_write(self._execute_batch, writes)
+        persistence_write_latency.observe(time.perf_counter() - started)
+        persistence_rows_written.inc(len(writes))
 
     def _create_tables(self):
-        """Create the necessary tables if they don't exist."""
+        """Create the tables of the current schema, migrating a legacy database if needed."""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        legacy = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_data'"
+        ).fetchone() is not None
+
         cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id INTEGER PRIMARY KEY,
-                data TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_data (
-                chat_id INTEGER PRIMARY KEY,
-                data TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_data (
-                key TEXT PRIMARY KEY DEFAULT 'bot_data',
-                data TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                name TEXT NOT NULL,
-                conv_key TEXT NOT NULL,
-                state BLOB,
-                PRIMARY KEY (name, conv_key)
+        cursor.execute("BEGIN")
+        try:
+            if legacy:
+                for table in ('user_data', 'chat_data', 'bot_data', 'conversations'):
+                    cursor.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
+
+            cursor.execute('''
+                CREATE TABLE user_data (
+                    user_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE chat_data (
+                    chat_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE bot_data (
+                    key TEXT PRIMARY KEY DEFAULT 'bot_data',
+                    data BLOB NOT NULL
+                )
+            ''')
+            # Conversation keys are tuples of up to three ids (chat, user, message),
+            # stored as integer columns padded with 0 plus the key length
+            cursor.execute('''
+                CREATE TABLE conversations (
+                    name TEXT NOT NULL,
+                    key_len INTEGER NOT NULL,
+                    k0 INTEGER NOT NULL DEFAULT 0,
+                    k1 INTEGER NOT NULL DEFAULT 0,
+                    k2 INTEGER NOT NULL DEFAULT 0,
+                    state BLOB NOT NULL,
+                    PRIMARY KEY (name, key_len, k0, k1, k2)
+                ) WITHOUT ROWID
+            ''')
+
+            if legacy:
+                self._migrate_legacy_rows(cursor)
+
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _migrate_legacy_rows(self, cursor: sqlite3.Cursor) -> None:
+        """Convert JSON/pickle rows of the original schema to the compact format."""
+        for table, key_column in (('user_data', 'user_id'), ('chat_data', 'chat_id'), ('bot_data', 'key')):
+            rows = cursor.execute(f"SELECT {key_column}, data FROM legacy_{table}").fetchall()
+            cursor.executemany(
+                f"INSERT INTO {table} ({key_column}, data) VALUES (?, ?)",
+                [(key, state_codec.encode(json.loads(data))) for key, data in rows]
             )
-        ''')
-        self.conn.commit()
+
+        # The only place pickle is still read: states written by the original schema
+        rows = cursor.execute("SELECT name, conv_key, state FROM legacy_conversations").fetchall()
+        cursor.executemany(
+            "INSERT INTO conversations (name, key_len, k0, k1, k2, state) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (name, *self._conv_key_columns(json.loads(conv_key)), state_codec.encode(pickle.loads(state)))
+                for name, conv_key, state in rows if state
+            ]
+        )
+
+        for table in ('user_data', 'chat_data', 'bot_data', 'conversations'):
+            cursor.execute(f"DROP TABLE legacy_{table}")
+        logger.info(f"Migrated persistence database {self.filepath} to schema version {SCHEMA_VERSION}")
+
+    @staticmethod
+    def _conv_key_columns(key) -> Tuple[int, Any, Any, Any]:
+        """Map a conversation key tuple to (key_len, k0, k1, k2)."""
+        if not 1 <= len(key) <= 3:
+            raise ValueError(f"Unsupported conversation key: {key!r}")
+        padded = tuple(key) + (0,) * (3 - len(key))
+        return (len(key),) + padded
+
+    def _is_unchanged(self, row: Tuple[str, Any], data: Any) -> bool:
+        """Check the data against the last persisted version of the row."""
+        if row in self._snapshots and self._snapshots[row] == data:
+            self.skipped_writes += 1
+            return True
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'writes': self.writes,
+            'skipped_writes': self.skipped_writes,
+            'pending_writes': len(self._pending),
+        }
+
+    async def _write(self, row: Tuple[str, Any], statement: str, params: tuple, snapshot: Any = None) -> None:
+        """
+        Execute a write immediately or buffer it in write-behind mode.
+        ``snapshot`` is remembered as the row's persisted content; deletes pass None.
+        """
+        self.writes += 1
+        if snapshot is None:
+            self._snapshots.pop(row, None)
+        else:
+            self._snapshots[row] = snapshot
+
+        if not self.write_interval:
+            try:
+                await self._commit_batch([(statement, params)])
+            except Exception:
+                self._snapshots.pop(row, None)
+                raise
+            return
+
+        self._pending[row] = (statement, params)
+        if len(self._pending) >= self.max_pending_writes:
+            await self._flush_pending()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_periodically())
+
+    async def _flush_pending(self) -> None:
+        """Write all buffered rows in a single transaction."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._commit_batch(list(pending.values()))
+        except Exception:
+            # Keep the rows so the next flush retries them; newer writes take precedence
+            for row, write in pending.items():
+                self._pending.setdefault(row, write)
+            raise
+
+    async def _flush_periodically(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.write_interval)
+            try:
+                await self._flush_pending()
+            except Exception as e:
+                logger.error(f"Failed to flush persistence writes: {e}")
 
     async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT user_id, data FROM user_data")
-        rows = cursor.fetchall()
+        await self._flush_pending()
+        rows = await self._run_read("SELECT user_id, data FROM user_data")
         user_data = defaultdict(dict)
         for user_id, data in rows:
-            user_data[user_id] = json.loads(data)
+            user_data[user_id] = state_codec.decode(data)
+            self._snapshots[('user_data', user_id)] = state_codec.decode(data)
         return user_data
 
     async def update_user_data(self, user_id: int, data: Dict) -> None:
-        cursor = self.conn.cursor()
-        json_data = json.dumps(data)
-        cursor.execute("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", (user_id, json_data))
-        self.conn.commit()
+        row = ('user_data', user_id)
+        if self._is_unchanged(row, data):
+            return
+        await self._write(
+            row,
+            "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+            (user_id, state_codec.encode(data)),
+            snapshot=data
+        )
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._write(('user_data', user_id), "DELETE FROM user_data WHERE user_id = ?", (user_id,))
 
     async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT chat_id, data FROM chat_data")
-        rows = cursor.fetchall()
+        await self._flush_pending()
+        rows = await self._run_read("SELECT chat_id, data FROM chat_data")
         chat_data = defaultdict(dict)
         for chat_id, data in rows:
-            chat_data[chat_id] = json.loads(data)
+            chat_data[chat_id] = state_codec.decode(data)
+            self._snapshots[('chat_data', chat_id)] = state_codec.decode(data)
         return chat_data
 
     async def update_chat_data(self, chat_id: int, data: Dict) -> None:
-        cursor = self.conn.cursor()
-        json_data = json.dumps(data)
-        cursor.execute("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)", (chat_id, json_data))
-        self.conn.commit()
+        row = ('chat_data', chat_id)
+        if self._is_unchanged(row, data):
+            return
+        await self._write(
+            row,
+            "INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
+            (chat_id, state_codec.encode(data)),
+            snapshot=data
+        )
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._write(('chat_data', chat_id), "DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
 
     async def get_bot_data(self) -> Dict[Any, Any]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT data FROM bot_data WHERE key = 'bot_data'")
-        row = cursor.fetchone()
-        if row:
-            return json.loads(row[0])
+        await self._flush_pending()
+        rows = await self._run_read("SELECT data FROM bot_data WHERE key = 'bot_data'")
+        if rows:
+            self._snapshots[('bot_data', 'bot_data')] = state_codec.decode(rows[0][0])
+            return state_codec.decode(rows[0][0])
         return {}
 
     async def update_bot_data(self, data: Dict) -> None:
-        cursor = self.conn.cursor()
-        json_data = json.dumps(data)
-        cursor.execute("INSERT OR REPLACE INTO bot_data (key, data) VALUES ('bot_data', ?)", (json_data,))
-        self.conn.commit()
+        row = ('bot_data', 'bot_data')
+        if self._is_unchanged(row, data):
+            return
+        await self._write(
+            row,
+            "INSERT OR REPLACE INTO bot_data (key, data) VALUES ('bot_data', ?)",
+            (state_codec.encode(data),),
+            snapshot=data
+        )
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
 
     async def get_conversations(self, name: str) -> Dict:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT conv_key, state FROM conversations WHERE name = ?", (name,))
-        rows = cursor.fetchall()
+        await self._flush_pending()
+        rows = await self._run_read(
+            "SELECT key_len, k0, k1, k2, state FROM conversations WHERE name = ?", (name,)
+        )
         conversations = {}
-        for conv_key_str, state_blob in rows:
-            conv_key = tuple(json.loads(conv_key_str))
-            if state_blob:
-                state = pickle.loads(state_blob)
-            else:
-                state = None
+        for key_len, k0, k1, k2, state_blob in rows:
+            conv_key = (k0, k1, k2)[:key_len]
+            state = state_codec.decode(state_blob)
             conversations[conv_key] = state
+            self._snapshots[('conversations', (name, conv_key))] = state
         return conversations
 
     async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
-        cursor = self.conn.cursor()
-        conv_key_str = json.dumps(key)
+        row = ('conversations', (name, tuple(key)))
+        key_columns = self._conv_key_columns(key)
         if new_state is None:
-            cursor.execute("DELETE FROM conversations WHERE name = ? AND conv_key = ?", (name, conv_key_str))
-        else:
-            state_blob = pickle.dumps(new_state)
-            cursor.execute("INSERT OR REPLACE INTO conversations (name, conv_key, state) VALUES (?, ?, ?)", (name, conv_key_str, state_blob))
-        self.conn.commit()
+            await self._write(
+                row,
+                "DELETE FROM conversations WHERE name = ? AND key_len = ? AND k0 = ? AND k1 = ? AND k2 = ?",
+                (name, *key_columns)
+            )
+        elif not self._is_unchanged(row, new_state):
+            await self._write(
+                row,
+                "INSERT OR REPLACE INTO conversations (name, key_len, k0, k1, k2, state) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, *key_columns, state_codec.encode(new_state)),
+                snapshot=new_state
+            )
 
     async def flush(self) -> None:
         if self.conn:
-            self.conn.commit()
+            await self._flush_pending()
+            await self._run_write(self.conn.commit)
 
     async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
         if self.conn:
-            self.conn.commit()
-            self.conn.close()
+            await self._flush_pending()
+            await self._run_write(self.conn.commit)
+            await self._run_write(self.conn.close)
+            await asyncio.get_running_loop().run_in_executor(self._reader, self.read_conn.close)
+            self.conn = None
+            self.read_conn = None
+        self._writer.shutdown()
+        self._reader.shutdown()
@@ -0,0 +1,69 @@
+import json
+import marshal
+from typing import Any
+
+# Версия формата записывается первым байтом каждой строки, чтобы формат
+# можно было поменять без миграции всей базы
+FORMAT_MARSHAL_V1 = 1
+FORMAT_JSON_V2 = 2
+CURRENT_FORMAT = FORMAT_JSON_V2
+
+# Формат 1 (marshal) больше не записывается: у marshal нет гарантии совместимости
+# между версиями Python. Такие строки только читаются и перезаписываются в формате 2
+# при следующем изменении.
+
+_ALLOWED_TYPES = (type(None), bool, int, float, str, list, tuple, dict)
+_ALLOWED_KEY_TYPES = (type(None), bool, int, float, str)
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+
+class StateCodecError(ValueError):
+    """Ошибка кодирования/декодирования сохраненного состояния"""
+
+
+def _check(obj: Any) -> None:
+    """
+    Разрешаем только простые данные, которые переживают запись в JSON.
+    Вызывается при записи, чтобы неподдерживаемое значение (set, объект и т.д.)
+    падало сразу, а не при следующем запуске бота.
+    """
+    if not isinstance(obj, _ALLOWED_TYPES):
+        raise StateCodecError(f"Неподдерживаемый тип в состоянии: {type(obj).__name__}")
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            _check(item)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if not isinstance(key, _ALLOWED_KEY_TYPES):
+                raise StateCodecError(f"Неподдерживаемый тип ключа в состоянии: {type(key).__name__}")
+            _check(value)
+
+
+def encode(obj: Any) -> bytes:
+    """Кодирует user_data/chat_data/bot_data или состояние диалога в bytes"""
+    _check(obj)
+    try:
+        return bytes((CURRENT_FORMAT,)) + _encoder.encode(obj).encode('utf-8')
+    except (TypeError, ValueError) as e:
+        raise StateCodecError(f"Не удалось закодировать состояние: {e}") from e
+
+
+def decode(blob: bytes) -> Any:
+    """Декодирует строку, записанную encode()"""
+    if not blob:
+        raise StateCodecError("Пустая строка состояния")
+    if blob[0] == FORMAT_JSON_V2:
+        try:
+            return json.loads(blob[1:].decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise StateCodecError(f"Поврежденная строка состояния: {e}") from e
+    if blob[0] == FORMAT_MARSHAL_V1:
+        try:
+            obj = marshal.loads(blob[1:])
+        except (EOFError, ValueError, TypeError) as e:
+            raise StateCodecError(f"Поврежденная строка состояния: {e}") from e
+        # marshal умеет больше типов (code, set и т.д.) — из старых строк берем только данные
+        _check(obj)
+        return obj
+    raise StateCodecError(f"Неизвестная версия формата состояния: {blob[0]}")
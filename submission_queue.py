@@ -0,0 +1,402 @@
+"""
+Очередь отправки заявок на бронирование.
+
+Подтвержденная заявка записывается в таблицу booking_submissions базы бота,
+пользователь сразу получает ответ «принято». Фоновый обработчик отправляет
+заявки на сайт (не больше SUBMISSION_CONCURRENCY одновременно), временные
+ошибки повторяет с экспоненциальной задержкой и присылает результат
+отдельным сообщением. Заявки переживают перезапуск бота.
+
+Ключ идемпотентности (пользователь, зал, дата, слоты) не дает поставить одну
+заявку дважды: повторное нажатие «Подтвердить» или повторная доставка того же
+обновления после перезапуска попадают в уже существующую запись. Заявка,
+которая могла дойти до сайта (ответ на POST потерян, бот перезапущен во время
+отправки), перед повтором сверяется со свободными слотами: если выбранные
+слоты уже заняты, повторная отправка не выполняется.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    PERSISTENCE_PATH, SUBMISSION_CONCURRENCY, SUBMISSION_MAX_ATTEMPTS, SUBMISSION_RETRY_BASE_DELAY,
+    SUBMISSION_RETRY_MAX_DELAY, SUBMISSION_POLL_INTERVAL, SUBMISSION_DEDUP_WINDOW, SUBMISSION_KEEP_DAYS
+)
+from booking_utils import submit_booking, recheck_selected_slots, form_prewarmer, RetryableSubmissionError
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Сколько секунд ждать завершения начатых отправок при остановке бота
+STOP_TIMEOUT = 10
+
+# Повторы записи состояния заявки: база общая с persistence и может быть занята
+DB_RETRY_ATTEMPTS = 6
+DB_RETRY_DELAY = 0.5
+
+GAVE_UP_MESSAGE = "Сайт бронирования сейчас недоступен, заявку отправить не удалось. Попробуйте позже."
+UNCERTAIN_MESSAGE = (
+    "Не удалось подтвердить, что заявка дошла до сайта: выбранные слоты уже заняты. "
+    "Проверьте расписание или свяжитесь с администрацией."
+)
+UNEXPECTED_MESSAGE = "Произошла непредвиденная ошибка при отправке бронирования."
+TAKEN_MESSAGE = "Выбранные слоты уже заняты: {}. Пожалуйста, начните бронирование заново."
+
+
+def idempotency_key(user_id, booking):
+    """Ключ заявки: одинаков для повторных подтверждений одних и тех же слотов"""
+    identity = [user_id, int(booking['room_id']), booking['date_str'], sorted(booking['selected_slots'])]
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()[:32]
+
+
+def retry_delay(attempt, base=SUBMISSION_RETRY_BASE_DELAY, maximum=SUBMISSION_RETRY_MAX_DELAY):
+    """Задержка перед повтором после attempt-й попытки: удвоение с разбросом ±20%"""
+    return min(maximum, base * 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+
+
+class SubmissionQueue:
+    """
+    Очередь заявок в SQLite и фоновый обработчик.
+    С базой работает отдельное соединение в своем потоке (как в SQLitePersistence).
+    """
+
+    def __init__(self, filepath=PERSISTENCE_PATH, concurrency=SUBMISSION_CONCURRENCY,
+                 max_attempts=SUBMISSION_MAX_ATTEMPTS, poll_interval=SUBMISSION_POLL_INTERVAL,
+                 dedup_window=SUBMISSION_DEDUP_WINDOW, keep_days=SUBMISSION_KEEP_DAYS):
+        self.filepath = filepath
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.dedup_window = dedup_window
+        self.keep_days = keep_days
+        self.application = None
+        self.conn = None
+        self._executor = None
+        self._worker = None
+        self._wakeup = None
+        self._active = set()
+        self._prepared = {}  # ключ -> задача подготовки формы (form_prewarmer.detach) для первой попытки
+        self.pending = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+
+    @property
+    def running(self):
+        return self._worker is not None
+
+    # --- База ---
+
+    def _open(self):
+        conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS booking_submissions (
+                    key TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    booking TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    maybe_sent INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL,
+                    success INTEGER,
+                    message TEXT,
+                    notified INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS booking_submissions_due ON booking_submissions (status, next_attempt_at)"
+            )
+        return conn
+
+    async def _run_db(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _update(self, func, key, *args):
+        """
+        Записывает состояние заявки, повторяя при ошибках SQLite (например, database is locked).
+        Если записать так и не удалось, заявка остается «отправляемой» и после перезапуска
+        будет перепроверена по слотам.
+        """
+        for attempt in range(DB_RETRY_ATTEMPTS):
+            try:
+                await self._run_db(func, key, *args)
+                return True
+            except sqlite3.Error as e:
+                logger.warning(f"Заявка {key}: ошибка записи в базу ({e}), попытка {attempt + 1}")
+                await asyncio.sleep(DB_RETRY_DELAY * 2 ** attempt)
+        logger.error(f"Заявка {key}: не удалось записать состояние ({func.__name__})")
+        return False
+
+    def _recover(self):
+        """
+        Заявки, отправка которых прервалась перезапуском, возвращаются в очередь
+        с пометкой «могла дойти»; старые завершенные записи удаляются.
+        """
+        now = time.time()
+        with self.conn:
+            recovered = self.conn.execute(
+                "UPDATE booking_submissions SET status = ?, maybe_sent = 1, next_attempt_at = ? WHERE status = ?",
+                (PENDING, now, SENDING)
+            ).rowcount
+            self.conn.execute(
+                "DELETE FROM booking_submissions WHERE status IN (?, ?) AND notified = 1 AND finished_at < ?",
+                (DONE, FAILED, now - self.keep_days * 86400)
+            )
+        return recovered
+
+    def _insert(self, key, user_id, chat_id, booking):
+        """
+        Ставит заявку в очередь. Если такая заявка уже принята или только что отправлена,
+        возвращает ее запись (статус, успех, сообщение), иначе None.
+        """
+        now = time.time()
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT status, finished_at, success, message FROM booking_submissions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                status, finished_at, success, message = row
+                if status in (PENDING, SENDING) or (status == DONE and now - finished_at < self.dedup_window):
+                    return status, success, message
+            self.conn.execute(
+                "INSERT OR REPLACE INTO booking_submissions "
+                "(key, user_id, chat_id, booking, status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, user_id, chat_id, json.dumps(booking, ensure_ascii=False), PENDING, now, now)
+            )
+            return None
+
+    def _claim(self, limit):
+        """Берет до limit заявок, время которых подошло, и помечает их отправляемыми"""
+        now = time.time()
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT key, user_id, chat_id, booking, attempts, maybe_sent FROM booking_submissions "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (PENDING, now, limit)
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE booking_submissions SET status = ?, attempts = attempts + 1 WHERE key = ?",
+                [(SENDING, row[0]) for row in rows]
+            )
+            self.pending = self.conn.execute(
+                "SELECT COUNT(*) FROM booking_submissions WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+            next_due = self.conn.execute(
+                "SELECT MIN(next_attempt_at) FROM booking_submissions WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+        return rows, next_due
+
+    def _reschedule(self, key, delay, maybe_sent):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE booking_submissions SET status = ?, next_attempt_at = ?, maybe_sent = maybe_sent OR ? "
+                "WHERE key = ?",
+                (PENDING, time.time() + delay, int(maybe_sent), key)
+            )
+
+    def _finish(self, key, success, message):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE booking_submissions SET status = ?, success = ?, message = ?, finished_at = ? WHERE key = ?",
+                (DONE if success else FAILED, int(success), message, time.time(), key)
+            )
+
+    def _mark_notified(self, key):
+        with self.conn:
+            self.conn.execute("UPDATE booking_submissions SET notified = 1 WHERE key = ?", (key,))
+
+    def _unnotified(self):
+        return self.conn.execute(
+            "SELECT key, user_id, chat_id, booking, success, message FROM booking_submissions "
+            "WHERE status IN (?, ?) AND notified = 0",
+            (DONE, FAILED)
+        ).fetchall()
+
+    # --- Жизненный цикл ---
+
+    async def start(self, application):
+        """Открывает базу, возвращает в очередь прерванные заявки и запускает обработчик"""
+        self.application = application
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="submission-queue")
+        self.conn = await self._run_db(self._open)
+        recovered = await self._run_db(self._recover)
+        if recovered:
+            logger.warning(f"Заявок, прерванных перезапуском, возвращено в очередь: {recovered}")
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+
+        # Результаты, которые не успели сообщить пользователям до остановки
+        for key, user_id, chat_id, booking, success, message in await self._run_db(self._unnotified):
+            await self._notify(key, user_id, chat_id, json.loads(booking), bool(success), message)
+
+    async def stop(self):
+        """Останавливает обработчик; незавершенные отправки продолжатся после перезапуска"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        if self._active:
+            await asyncio.wait(self._active, timeout=STOP_TIMEOUT)
+            for task in self._active:
+                task.cancel()
+            await asyncio.gather(*self._active, return_exceptions=True)
+        await asyncio.gather(*(form_prewarmer.drop(task) for task in self._prepared.values()),
+                             return_exceptions=True)
+        self._prepared.clear()
+        await self._run_db(self.conn.close)
+        self.conn = None
+        self._executor.shutdown()
+
+    async def enqueue(self, user_id, chat_id, booking, prepared=None):
+        """
+        Записывает заявку (аргументы submit_booking) в очередь; prepared — задача
+        form_prewarmer.detach(), ее дождется первая попытка отправки.
+        Возвращает (создана, статус, результат): результат (успех, сообщение) есть
+        только у уже отправленной заявки. sqlite3.Error пробрасывается, задача prepared
+        в этом случае остается у вызывающего.
+        """
+        key = idempotency_key(user_id, booking)
+        existing = await self._run_db(self._insert, key, user_id, chat_id, booking)
+        if existing is not None:
+            self.duplicates += 1
+            if prepared is not None:
+                form_prewarmer.drop(prepared)
+            status, success, message = existing
+            return False, status, (bool(success), message) if status in (DONE, FAILED) else None
+
+        self.accepted += 1
+        if prepared is not None:
+            self._prepared[key] = prepared
+        self._wakeup.set()
+        return True, PENDING, None
+
+    # --- Обработка ---
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._active)
+            timeout = self.poll_interval
+            try:
+                rows, next_due = await self._run_db(self._claim, max(free, 0))
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка чтения очереди заявок: {e}")
+                rows, next_due = [], None
+            for row in rows:
+                task = asyncio.create_task(self._process(*row))
+                self._active.add(task)
+                task.add_done_callback(self._task_done)
+            if next_due is not None and free > len(rows):
+                timeout = min(timeout, max(0.0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _task_done(self, task):
+        self._active.discard(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _process(self, key, user_id, chat_id, booking_json, attempts, maybe_sent):
+        booking = json.loads(booking_json)
+        attempts += 1
+        prepared_task = self._prepared.pop(key, None)
+        try:
+            if attempts == 1:
+                # Последняя проверка: слоты могли занять между ответом «принято» и отправкой
+                current_slots, taken = await recheck_selected_slots(
+                    booking['room_id'], booking['date_str'], booking['selected_slots']
+                )
+                if taken:
+                    if prepared_task is not None:
+                        form_prewarmer.drop(prepared_task)
+                    labels = dict(booking['all_slots'])
+                    message = TAKEN_MESSAGE.format(", ".join(labels.get(slot, slot) for slot in taken))
+                    await self._complete(key, user_id, chat_id, booking, False, message)
+                    return
+            elif maybe_sent:
+                # Прошлая попытка могла дойти до сайта: если все выбранные слоты заняты,
+                # повторная отправка создала бы вторую заявку
+                current_slots, taken = await recheck_selected_slots(
+                    booking['room_id'], booking['date_str'], booking['selected_slots'], max_age=0
+                )
+                if current_slots is None:
+                    raise RetryableSubmissionError("не удалось проверить слоты", maybe_sent=True)
+                if len(taken) == len(booking['selected_slots']):
+                    logger.warning(f"Заявка {key}: слоты заняты после прерванной отправки, повтор не выполняется")
+                    await self._complete(key, user_id, chat_id, booking, False, UNCERTAIN_MESSAGE)
+                    return
+            # Подготовленная форма есть только у первой попытки; submit_booking сам закрывает ее сессию
+            prepared = await form_prewarmer.resolve(prepared_task) if prepared_task is not None else None
+            success, message = await submit_booking(**booking, prepared=prepared, raise_retryable=True)
+        except RetryableSubmissionError as e:
+            if attempts >= self.max_attempts:
+                logger.error(f"Заявка {key}: попытки исчерпаны ({attempts}), последняя ошибка: {e}")
+                await self._complete(key, user_id, chat_id, booking, False, GAVE_UP_MESSAGE)
+                return
+            delay = retry_delay(attempts)
+            self.retries += 1
+            logger.warning(f"Заявка {key}: временная ошибка ({e}), попытка {attempts}, повтор через {delay:.0f} с")
+            await self._update(self._reschedule, key, delay, e.maybe_sent)
+            return
+        except Exception as e:
+            logger.error(f"Заявка {key}: непредвиденная ошибка: {e}", exc_info=True)
+            await self._complete(key, user_id, chat_id, booking, False, UNEXPECTED_MESSAGE)
+            return
+
+        await self._complete(key, user_id, chat_id, booking, success, message)
+
+    async def _complete(self, key, user_id, chat_id, booking, success, message):
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        await self._update(self._finish, key, success, message)
+        await self._notify(key, user_id, chat_id, booking, success, message)
+
+    async def _notify(self, key, user_id, chat_id, booking, success, message):
+        """Сообщает результат пользователю; при успехе запоминает его имя и телефон"""
+        if success:
+            user_data = self.application.user_data[user_id]
+            user_data['user_name'] = booking['user_name']
+            user_data['user_phone'] = booking['phone_number']
+            self.application.mark_data_for_update_persistence(user_ids=user_id)
+        try:
+            await self.application.bot.send_message(chat_id=chat_id, text=f"✅ {message}" if success else f"❌ {message}")
+        except Exception as e:
+            # Сообщение будет отправлено повторно при следующем запуске
+            logger.error(f"Не удалось сообщить результат заявки {key}: {e}")
+            return
+        await self._update(self._mark_notified, key)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'sending': len(self._active),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retries': self.retries,
+        }
+
+
+submission_queue = SubmissionQueue()
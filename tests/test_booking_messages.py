@@ -0,0 +1,31 @@
+import json
+import os
+import unittest
+
+from api_utils import Booking
+from handlers import build_booking_messages, pack_messages
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fixtures')
+USER_ID = 100500  # не администратор
+
+
+def load_bookings():
+    with open(os.path.join(FIXTURES, 'schedule_api.json'), encoding='utf-8') as f:
+        return [Booking.from_dict(item) for item in json.load(f)]
+
+
+class BookingMessagesTest(unittest.TestCase):
+    def test_single_blank_line_between_sections(self):
+        bookings = load_bookings()
+        self.assertGreater(len({booking.room_id for booking in bookings}), 1)
+
+        messages = pack_messages(build_booking_messages(bookings, USER_ID, 'all'))
+
+        for message in messages:
+            self.assertNotIn("\n\n\n", message)
+            self.assertFalse(message.startswith("\n"))
+        self.assertIn("\n\n🚪 ", messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
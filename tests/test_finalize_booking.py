@@ -0,0 +1,97 @@
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram.ext import ConversationHandler
+
+import booking_utils
+import handlers
+
+ROOM_ID = 3
+DATE = '2030-05-06'
+SLOTS = [('10:00', '10:00 - 11:00 (₽500)'), ('11:00', '11:00 - 12:00 (₽500)')]
+
+
+class FakeQueue:
+    running = True
+
+    def __init__(self):
+        self.enqueued = []
+
+    async def enqueue(self, user_id, chat_id, booking, prepared=None):
+        self.enqueued.append(booking)
+        return True, 'pending', None
+
+
+class FinalizeBookingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        booking_utils.slots_cache.clear()
+        self.edits = []
+        self.messages = []
+        self.queue = FakeQueue()
+
+        async def edit_message_text(text, **kwargs):
+            self.edits.append(text)
+
+        async def send_message(chat_id, text, **kwargs):
+            self.messages.append(text)
+
+        self.update = SimpleNamespace(
+            callback_query=SimpleNamespace(edit_message_text=edit_message_text),
+            message=None,
+            effective_chat=SimpleNamespace(id=1),
+            effective_user=SimpleNamespace(id=1),
+        )
+        self.context = SimpleNamespace(
+            bot=SimpleNamespace(send_message=send_message),
+            user_data={
+                'booking_room_id': ROOM_ID,
+                'booking_room_name': 'Кузня',
+                'booking_date': DATE,
+                'booking_slots': list(SLOTS),
+                'selected_slots': ['10:00', '11:00'],
+                'booking_name': 'Иван',
+                'booking_phone': '+79110000000',
+                'booking_comment': 'Пропущено',
+            },
+        )
+
+    def tearDown(self):
+        booking_utils.slots_cache.clear()
+
+    async def test_queue_enabled_expired_cache_taken_slot_returns_to_picker(self):
+        # Запись кэша слотов старше TTL: оба слота были свободны, когда пользователь их выбирал
+        booking_utils.slots_cache._entries[(ROOM_ID, DATE)] = (time.monotonic() - 1000, list(SLOTS))
+        site = mock.AsyncMock(return_value=[SLOTS[1]])  # 10:00 заняли, пока вводились данные
+
+        with mock.patch.object(handlers, 'SUBMISSION_QUEUE_ENABLED', True), \
+                mock.patch.object(handlers, 'submission_queue', self.queue), \
+                mock.patch.object(booking_utils, 'fetch_available_slots', site):
+            state = await handlers.finalize_booking(self.update, self.context)
+
+        self.assertEqual(state, handlers.BOOKING_SLOTS)
+        site.assert_awaited_once_with(ROOM_ID, DATE)
+        self.assertEqual(self.queue.enqueued, [])
+        self.assertFalse(any("принята" in text for text in self.messages))
+        self.assertIn("10:00 - 11:00", self.edits[-1])
+        self.assertEqual(self.context.user_data['booking_slots'], [SLOTS[1]])
+        self.assertEqual(self.context.user_data['selected_slots'], ['11:00'])
+        self.assertTrue(self.context.user_data['booking_resume_summary'])
+
+    async def test_queue_enabled_free_slots_are_queued(self):
+        site = mock.AsyncMock(return_value=list(SLOTS))
+
+        with mock.patch.object(handlers, 'SUBMISSION_QUEUE_ENABLED', True), \
+                mock.patch.object(handlers, 'submission_queue', self.queue), \
+                mock.patch.object(booking_utils, 'fetch_available_slots', site):
+            state = await handlers.finalize_booking(self.update, self.context)
+
+        self.assertEqual(state, ConversationHandler.END)
+        self.assertEqual(len(self.queue.enqueued), 1)
+        self.assertEqual(self.queue.enqueued[0]['selected_slots'], ['10:00', '11:00'])
+        self.assertIn("принята", self.messages[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import marshal
+import unittest
+
+import state_codec
+
+
+class StateCodecTest(unittest.TestCase):
+    def test_roundtrip(self):
+        data = {'selected_slots': ['09:00-09:30', '09:30-10:00'], 'room_id': 3, 'name': 'Иван', 'date': None}
+        blob = state_codec.encode(data)
+        self.assertEqual(blob[0], state_codec.FORMAT_JSON_V2)
+        self.assertIn('Иван'.encode('utf-8'), blob)
+        self.assertEqual(state_codec.decode(blob), data)
+
+    def test_unsupported_value_fails_on_encode(self):
+        for value in ({'slots': {'09:00'}}, {'slots': frozenset()}, {'raw': b'x'}, {(1, 2): 'tuple key'}):
+            with self.subTest(value=value):
+                with self.assertRaises(state_codec.StateCodecError):
+                    state_codec.encode(value)
+
+    def test_legacy_marshal_rows_are_readable(self):
+        blob = bytes((state_codec.FORMAT_MARSHAL_V1,)) + marshal.dumps({'room_id': 3}, 4)
+        self.assertEqual(state_codec.decode(blob), {'room_id': 3})
+
+        bad = bytes((state_codec.FORMAT_MARSHAL_V1,)) + marshal.dumps({'slots': {'09:00'}}, 4)
+        with self.assertRaises(state_codec.StateCodecError):
+            state_codec.decode(bad)
+
+    def test_unknown_format(self):
+        with self.assertRaises(state_codec.StateCodecError):
+            state_codec.decode(b'\x09{}')
+
+
+if __name__ == '__main__':
+    unittest.main()
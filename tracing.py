@@ -0,0 +1,161 @@
+"""
+Трассировка обработки обновлений.
+
+Для каждого обновления создается трасса; участки кода отмечаются span(...)
+(обработчики, запросы к внешним сервисам и Bot API, разбор страниц, база).
+Если обновление обрабатывалось дольше SLOW_UPDATE_THRESHOLD секунд,
+трасса с разбивкой по участкам пишется в лог.
+
+При включенном профилировании часть обновлений (PROFILE_SAMPLE_RATE)
+выполняется под cProfile; профили медленных из них сохраняются в PROFILE_DIR
+для анализа (python -m pstats <файл>). cProfile работает на весь поток,
+поэтому в профиль попадают и другие обновления, обрабатываемые в это время,
+и одновременно активен только один профилировщик.
+"""
+import cProfile
+import contextvars
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from telegram import Update
+from config import (
+    SLOW_UPDATE_THRESHOLD, PROFILE_SLOW_UPDATES, PROFILE_SAMPLE_RATE, PROFILE_DIR, PROFILE_MAX_FILES
+)
+
+logger = logging.getLogger(__name__)
+
+# Не больше стольких участков в одной трассе
+MAX_SPANS = 200
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_span_depth = contextvars.ContextVar('span_depth', default=0)
+
+
+class Trace:
+    def __init__(self, description):
+        self.description = description
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (смещение начала, глубина, имя, длительность)
+        self.dropped_spans = 0
+
+    def add_span(self, offset, depth, name, duration):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((offset, depth, name, duration))
+        else:
+            self.dropped_spans += 1
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def format(self):
+        lines = [f"Медленное обновление {self.description}: {self.duration:.3f} с"]
+        for offset, depth, name, duration in sorted(self.spans):
+            lines.append(f"{'  ' * (depth + 1)}+{offset:.3f} с {duration:.3f} с {name}")
+        if self.dropped_spans:
+            lines.append(f"  ... еще участков: {self.dropped_spans}")
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(name):
+    """Отмечает участок текущей трассы; вне трассы ничего не делает"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    depth = _span_depth.get()
+    token = _span_depth.set(depth + 1)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        finished = time.perf_counter()
+        _span_depth.reset(token)
+        trace.add_span(started - trace.started, depth, name, finished - started)
+
+
+def describe_update(update):
+    """Краткое описание обновления для лога (без текста сообщений)"""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    parts = [f"#{update.update_id}"]
+    if update.callback_query is not None:
+        parts.append(f"callback {update.callback_query.data!r}")
+    elif update.message is not None:
+        parts.append("command" if (update.message.text or '').startswith('/') else "message")
+    if update.effective_user is not None:
+        parts.append(f"user {update.effective_user.id}")
+    return " ".join(parts)
+
+
+class Profiler:
+    """Выборочное профилирование обновлений (включается в config или командой /profiling)"""
+
+    def __init__(self, enabled=PROFILE_SLOW_UPDATES, sample_rate=PROFILE_SAMPLE_RATE,
+                 directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_files = max_files
+        self.saved = 0
+        self._active = None
+
+    def start(self):
+        """Профилировщик для обновления или None (не выбрано или уже идет профилирование)"""
+        if not self.enabled or self._active is not None or self.saved >= self.max_files:
+            return None
+        if random.random() >= self.sample_rate:
+            return None
+        self._active = cProfile.Profile()
+        self._active.enable()
+        return self._active
+
+    def stop(self, profile, trace):
+        profile.disable()
+        self._active = None
+        if trace.duration < SLOW_UPDATE_THRESHOLD:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.description.split(' ', 1)[0].lstrip('#')}.prof"
+            )
+            profile.dump_stats(path)
+            self.saved += 1
+            logger.warning(f"Профиль медленного обновления сохранен: {path}")
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль: {e}")
+
+
+profiler = Profiler()
+
+
+@contextmanager
+def trace_update(update):
+    """Трасса обработки обновления; медленные обновления пишутся в лог"""
+    trace = Trace(describe_update(update))
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+        if trace.duration >= SLOW_UPDATE_THRESHOLD:
+            logger.warning(trace.format())
+
+
+@contextmanager
+def profiled(trace):
+    """Выполняет блок под cProfile, если обновление попало в выборку"""
+    profile = profiler.start()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            trace.finish()
+            profiler.stop(profile, trace)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from telegram import Update
+from telegram.ext import Application
+from config import UPDATE_WORKERS
+from tracing import trace_update, profiled, span
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessingStats:
+    """Счетчики параллельной обработки обновлений"""
+
+    def __init__(self):
+        self.processed = 0
+        self.in_progress = 0
+        self.waiting_for_user = 0
+        self.waiting_for_worker = 0
+        self.user_waits = 0
+        self.total_user_wait = 0.0
+        self.max_user_wait = 0.0
+
+    def record_user_wait(self, seconds):
+        self.user_waits += 1
+        self.total_user_wait += seconds
+        if seconds > self.max_user_wait:
+            self.max_user_wait = seconds
+
+    def as_dict(self, queue_size=0):
+        return {
+            'queue_size': queue_size,
+            'waiting_for_user': self.waiting_for_user,
+            'waiting_for_worker': self.waiting_for_worker,
+            'in_progress': self.in_progress,
+            'processed': self.processed,
+            'avg_user_wait': round(self.total_user_wait / self.user_waits, 4) if self.user_waits else 0.0,
+            'max_user_wait': round(self.max_user_wait, 4),
+        }
+
+
+class _UserLocks:
+    """Замки по пользователю; замок удаляется, когда его больше никто не ждет"""
+
+    def __init__(self):
+        self._locks = {}  # user_id -> [asyncio.Lock, число владельцев и ожидающих]
+
+    async def acquire(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release_ref(user_id, entry)
+            raise
+
+    def release(self, user_id):
+        entry = self._locks[user_id]
+        entry[0].release()
+        self._release_ref(user_id, entry)
+
+    def _release_ref(self, user_id, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[user_id]
+
+
+class ConcurrentApplication(Application):
+    """
+    Application, обрабатывающее обновления разных пользователей параллельно
+    (не более UPDATE_WORKERS одновременно), а обновления одного пользователя —
+    строго по очереди, в порядке поступления. Это сохраняет согласованность
+    ConversationHandler и context.user_data.
+
+    Замок пользователя берется до слота обработчика, чтобы обновления,
+    ждущие своей очереди, не занимали слоты других пользователей.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._workers = asyncio.Semaphore(UPDATE_WORKERS or 1)
+        self._user_locks = _UserLocks()
+        self.processing_stats = ProcessingStats()
+
+    async def process_update(self, update: object) -> None:
+        with trace_update(update) as trace:
+            await self._process_traced(update, trace)
+
+    async def _process_traced(self, update, trace):
+        stats = self.processing_stats
+        user = update.effective_user if isinstance(update, Update) else None
+        user_id = user.id if user else None
+
+        if user_id is not None:
+            started = time.monotonic()
+            stats.waiting_for_user += 1
+            try:
+                with span("ожидание предыдущих обновлений пользователя"):
+                    await self._user_locks.acquire(user_id)
+            finally:
+                stats.waiting_for_user -= 1
+            stats.record_user_wait(time.monotonic() - started)
+
+        try:
+            stats.waiting_for_worker += 1
+            try:
+                with span("ожидание свободного обработчика"):
+                    await self._workers.acquire()
+            finally:
+                stats.waiting_for_worker -= 1
+
+            stats.in_progress += 1
+            try:
+                with profiled(trace):
+                    await super().process_update(update)
+            finally:
+                stats.in_progress -= 1
+                stats.processed += 1
+                self._workers.release()
+        finally:
+            if user_id is not None:
+                self._user_locks.release(user_id)
+
+    def processing_snapshot(self):
+        return self.processing_stats.as_dict(self.update_queue.qsize())
@@ -0,0 +1,228 @@
+"""
+Режим webhook: встроенный HTTP-сервер принимает обновления от Telegram
+и кладет их в (ограниченную) очередь обновлений приложения.
+
+Локальная проверка: WEBHOOK_ENABLED = True, WEBHOOK_SET_ON_START = False,
+заданный WEBHOOK_SECRET_TOKEN и
+    curl -X POST http://127.0.0.1:8443/telegram \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET_TOKEN>' \\
+         -H 'Content-Type: application/json' \\
+         -d '{"update_id": 1, "message": {...}}'
+"""
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+from telegram import Update
+from config import (
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_SET_ON_START, WEBHOOK_MAX_CONNECTIONS, DROP_PENDING_UPDATES
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+IDLE_TIMEOUT = 60
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    503: 'Service Unavailable'
+}
+
+
+class WebhookServer:
+    """
+    Минимальный HTTP/1.1 сервер (keep-alive) для приема обновлений.
+    Если очередь обновлений заполнена, отвечает 503 — Telegram повторит доставку позже.
+    """
+
+    def __init__(self, update_queue, bot, secret_token, listen=WEBHOOK_LISTEN,
+                 port=WEBHOOK_PORT, path=WEBHOOK_PATH):
+        self.update_queue = update_queue
+        self.bot = bot
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self._server = None
+        self._connections = set()
+        self.accepted = 0
+        self.rejected = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.listen, self.port, limit=MAX_HEADER_SIZE
+        )
+        logger.info(f"Webhook слушает http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Server.close() не закрывает уже открытые keep-alive соединения
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 413, keep_alive=False)
+                    break
+
+                keep_alive = await self._handle_request(head, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса webhook: {e}", exc_info=True)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, head, reader, writer):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            await self._respond(writer, 400, keep_alive=False)
+            return False
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+        length = headers.get('content-length')
+        if length is None or not length.isdigit():
+            await self._respond(writer, 411, keep_alive=False)
+            return False
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            await self._respond(writer, 413, keep_alive=False)
+            return False
+        body = await reader.readexactly(length)
+
+        if target.split('?', 1)[0] != self.path:
+            status = 404
+        elif method != 'POST':
+            status = 405
+        elif not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning("Webhook: запрос с неверным секретным токеном")
+            status = 403
+        else:
+            status = self._enqueue(body)
+
+        await self._respond(writer, status, keep_alive)
+        return keep_alive
+
+    def _enqueue(self, body):
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception as e:
+            logger.warning(f"Webhook: не удалось разобрать обновление: {e}")
+            return 400
+        if update is None:
+            return 400
+
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning("Webhook: очередь обновлений заполнена, отвечаем 503")
+            return 503
+
+        self.accepted += 1
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive):
+        headers = [
+            f"HTTP/1.1 {status} {_REASONS[status]}",
+            "Content-Length: 0",
+            "Connection: keep-alive" if keep_alive else "Connection: close",
+        ]
+        if status == 503:
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+
+
+def _check_settings():
+    """Настройки, с которыми бот молча не получит ни одного обновления"""
+    if WEBHOOK_SET_ON_START and not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL не задан: set_webhook с пустым адресом удаляет webhook в Telegram")
+    if not WEBHOOK_SET_ON_START and not WEBHOOK_SECRET_TOKEN:
+        raise ValueError(
+            "При WEBHOOK_SET_ON_START = False нужен WEBHOOK_SECRET_TOKEN: "
+            "случайный токен не будет известен ни Telegram, ни локальным запросам"
+        )
+
+
+async def run_webhook(app):
+    """Запускает приложение в режиме webhook до SIGINT/SIGTERM"""
+    _check_settings()
+    secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # Порядок как в Application.run_polling: post_shutdown — после app.shutdown(),
+    # и каждый следующий шаг остановки выполняется, даже если предыдущий упал
+    server = None
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+
+        if WEBHOOK_SET_ON_START:
+            # Без drop_pending_updates Telegram доставит обновления, накопившиеся за время простоя
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=secret_token,
+                drop_pending_updates=DROP_PENDING_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+
+        server = WebhookServer(app.update_queue, app.bot, secret_token)
+        await app.start()
+        await server.start()
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook...")
+        try:
+            try:
+                if server is not None:
+                    await server.stop()
+            finally:
+                try:
+                    if app.running:
+                        await app.stop()
+                finally:
+                    if app.post_stop:
+                        await app.post_stop(app)
+        finally:
+            try:
+                await app.shutdown()
+            finally:
+                if app.post_shutdown:
+                    await app.post_shutdown(app)